@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Purpose: Benchmark the BeautifulSoup page parsing against the single pass
+PageExtractor on saved Launtel modify service and advanced info pages
+
+The BeautifulSoup functions are in soup_reference.py, install bs4 and lxml
+with benchmarks/requirements.txt. Save the pages from a browser (or the fake
+portal) and pass their paths:
+    pip install --user -r ./benchmarks/requirements.txt
+    ./benchmarks/bench_extract.py service.html advanced.html
+"""
+import argparse
+import os
+import sys
+import timeit
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mlss  # noqa: E402 pylint: disable=wrong-import-position
+import soup_reference  # noqa: E402 pylint: disable=wrong-import-position
+
+
+def soup_extract(html, kind):
+    """
+    Extract the page dicts with the BeautifulSoup functions
+    """
+    soup = BeautifulSoup(html, features='lxml')
+    if kind == 'shaper':
+        return soup_reference.get_shaper_control(soup)
+    return (soup_reference.get_service_dict(soup),
+            soup_reference.get_speeds_dict(soup))
+
+
+def single_pass_extract(html, kind):
+    """
+    Extract the page dicts with the PageExtractor
+    """
+    if kind == 'shaper':
+        return mlss.extract_page(html, mlss._SHAPER_FIELDS).shaper_control()  # pylint: disable=protected-access
+    page = mlss.extract_page(html)
+    return page.service_dict(), page.speeds_dict()
+
+
+def page_kind(html):
+    """
+    Return the kind of saved page, None if not supported
+    """
+    if b'form-shaping' in html:
+        return 'shaper'
+    if b'manage_service' in html:
+        return 'service'
+    return None
+
+
+def main():
+    """
+    Compare both parsers on each page and print the timings
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark BeautifulSoup against the PageExtractor')
+    parser.add_argument('pages', nargs='+', help='Saved HTML pages')
+    parser.add_argument('-n', '--number', type=int, default=200,
+                        help='Parses per timing')
+    args = parser.parse_args()
+
+    _failed = False
+    print(f'{"PAGE":30} {"KIND":8} {"SOUP ms":>9} {"PASS ms":>9} {"SPEEDUP":>8}')
+    for _path in args.pages:
+        with open(_path, 'rb') as _file:
+            _html = _file.read()
+        _kind = page_kind(_html)
+        if _kind is None:
+            print(f'{os.path.basename(_path):30} skipped, not a service or advanced info page')
+            continue
+        if soup_extract(_html, _kind) != single_pass_extract(_html, _kind):
+            print(f'{os.path.basename(_path):30} {_kind:8} MISMATCH')
+            _failed = True
+            continue
+        _soup = timeit.timeit(lambda: soup_extract(_html, _kind),
+                              number=args.number) / args.number * 1000
+        _pass = timeit.timeit(lambda: single_pass_extract(_html, _kind),
+                              number=args.number) / args.number * 1000
+        print(f'{os.path.basename(_path):30} {_kind:8} {_soup:9.3f} {_pass:9.3f} {_soup / _pass:7.1f}x')
+    return 1 if _failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Purpose: Benchmark mlss.py startup, the module import time reported by
+python -X importtime and the wall time of mlss.py --help
+
+    ./benchmarks/bench_import.py --max-import-ms 80
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_MLSS = os.path.join(_ROOT, 'mlss.py')
+
+
+def import_times():
+    """
+    Return the cumulative import time in microseconds of each module
+    imported by mlss
+    """
+    _proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import mlss'],
+        cwd=_ROOT, capture_output=True, text=True, check=True)
+    _times = {}
+    for _line in _proc.stderr.splitlines():
+        if not _line.startswith('import time:') or '|' not in _line:
+            continue
+        _fields = _line.split('|')
+        try:
+            _cumulative = int(_fields[1])
+        except ValueError:
+            continue
+        _times[_fields[2].strip()] = _cumulative
+    return _times
+
+
+def help_time():
+    """
+    Return the wall time in seconds of mlss.py --help
+    """
+    _start = time.perf_counter()
+    subprocess.run([sys.executable, _MLSS, '--help'], cwd=_ROOT,
+                   stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - _start
+
+
+def main():
+    """
+    Measure and print the startup times
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark mlss.py import and --help startup time')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='Runs, the median is reported')
+    parser.add_argument('--top', type=int, default=10,
+                        help='Slowest imports to list')
+    parser.add_argument('--max-import-ms', type=float,
+                        help='Fail if importing mlss takes longer')
+    args = parser.parse_args()
+
+    _runs = [import_times() for _ in range(args.runs)]
+    _median = {_name: statistics.median(_run.get(_name, 0) for _run in _runs)
+               for _name in _runs[0]}
+    _mlss_ms = _median.get('mlss', 0) / 1000
+    _help_s = statistics.median(help_time() for _ in range(args.runs))
+
+    print(f'import mlss:     {_mlss_ms:8.1f} ms')
+    print(f'mlss.py --help:  {_help_s * 1000:8.1f} ms')
+    print('Slowest imports (cumulative):')
+    _imports = [(_name, _us) for _name, _us in _median.items()
+                if _name != 'mlss']
+    for _name, _us in sorted(_imports, key=lambda x: -x[1])[:args.top]:
+        print(f'  {_name:30} {_us / 1000:8.1f} ms')
+    for _heavy in ['mechanize', 'bs4', 'rich', 'dotenv']:
+        if any(_name == _heavy or _name.startswith(f'{_heavy}.')
+               for _name in _median):
+            print(f'WARNING {_heavy} is imported at startup')
+    if args.max_import_ms is not None and _mlss_ms > args.max_import_ms:
+        print(f'REGRESSION import mlss {_mlss_ms:.1f} ms > {args.max_import_ms} ms')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Purpose: End to end benchmark of mlss.py against the fake Launtel portal
+
+Runs each mlss.py mode against benchmarks/fake_portal.py and reports the wall
+time, portal requests, connections and bytes sent. Save a baseline with --save and catch
+request count or wall time regressions with --check.
+
+    ./benchmarks/bench_portal.py --latency 0.05 --save baseline.json
+    ./benchmarks/bench_portal.py --latency 0.05 --check baseline.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_portal  # noqa: E402 pylint: disable=wrong-import-position
+
+_MLSS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                     'mlss.py')
+
+MODES = {
+    'view': ['-p', '2249'],
+    'commit': ['-p', '2249', '-c'],
+    'latest': ['-l', '-p', '2249', '-c'],
+    'shaper': ['-c', 'shaper'],
+}
+
+
+def run_mode(portal, mode_args, extra_args):
+    """
+    Run mlss.py once, return wall time, requests, connections, bytes and
+    exit code
+    """
+    portal.reset_stats()
+    _env = dict(os.environ,
+                LAUNTEL_BASE_URL=portal.url,
+                LAUNTEL_USERNAME=fake_portal.USERNAME,
+                LAUNTEL_PASSWORD=fake_portal.PASSWORD)
+    _start = time.perf_counter()
+    _proc = subprocess.run([sys.executable, _MLSS] + extra_args + mode_args,
+                           env=_env, stdin=subprocess.DEVNULL,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                           check=False)
+    _wall = time.perf_counter() - _start
+    if _proc.returncode != 0:
+        sys.stderr.write(_proc.stderr.decode('utf-8', 'replace'))
+    return {'wall': _wall,
+            'requests': portal.stats['requests'],
+            'connections': portal.stats['connections'],
+            'bytes': portal.stats['bytes_sent'],
+            'returncode': _proc.returncode}
+
+
+def check_results(results, baseline, tolerance):
+    """
+    Return a list of regressions against a saved baseline
+    """
+    _regressions = []
+    for _mode, _result in results.items():
+        if _mode not in baseline:
+            continue
+        _base = baseline[_mode]
+        if _result['requests'] > _base['requests']:
+            _regressions.append(
+                f'{_mode}: requests {_base["requests"]} -> {_result["requests"]}')
+        if _result['wall'] > _base['wall'] * (1 + tolerance):
+            _regressions.append(
+                f'{_mode}: wall {_base["wall"]:.3f}s -> {_result["wall"]:.3f}s')
+    return _regressions
+
+
+def main():
+    """
+    Benchmark each mode and print the results
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark mlss.py against the fake Launtel portal')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every portal request')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of portal requests answered with a 503')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='Runs per mode, the median is reported')
+    parser.add_argument('--mode', action='append', choices=sorted(MODES),
+                        help='Mode to run, all by default')
+    parser.add_argument('--args', default='',
+                        help='Extra mlss.py arguments, pass them with = as '
+                             'they start with -, e.g. --args="--stats -q"')
+    parser.add_argument('--save', metavar='FILE',
+                        help='Save the results as a JSON baseline')
+    parser.add_argument('--check', metavar='FILE',
+                        help='Fail on regressions against a JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='Allowed wall time increase for --check')
+    args = parser.parse_args()
+
+    portal = fake_portal.FakePortal(latency=args.latency,
+                                    error_rate=args.error_rate).start()
+    results = {}
+    try:
+        print(f'{"MODE":8} {"WALL s":>8} {"REQUESTS":>9} {"CONNS":>6} {"BYTES":>9} {"RC":>3}')
+        for _mode in args.mode or MODES:
+            _runs = [run_mode(portal, MODES[_mode], args.args.split())
+                     for _ in range(args.runs)]
+            results[_mode] = {
+                'wall': statistics.median(_run['wall'] for _run in _runs),
+                'requests': max(_run['requests'] for _run in _runs),
+                'connections': max(_run['connections'] for _run in _runs),
+                'bytes': max(_run['bytes'] for _run in _runs),
+                'returncode': max(_run['returncode'] for _run in _runs),
+            }
+            _result = results[_mode]
+            print(f'{_mode:8} {_result["wall"]:8.3f} {_result["requests"]:9} '
+                  f'{_result["connections"]:6} {_result["bytes"]:9} {_result["returncode"]:3}')
+    finally:
+        portal.stop()
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as _file:
+            json.dump(results, _file, indent=2)
+    if args.check:
+        with open(args.check, encoding='utf-8') as _file:
+            _regressions = check_results(results, json.load(_file),
+                                         args.tolerance)
+        for _regression in _regressions:
+            print(f'REGRESSION {_regression}')
+        return 1 if _regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Purpose: Offline benchmark of mlss.py replaying a recorded portal cassette
+
+Record a cassette with mlss.py --record against the portal (or with --record
+here against benchmarks/fake_portal.py), then time the page extraction, the
+client calls and the full CLI flow at memory speed. Save a baseline with
+--save and catch parse time or request count regressions, e.g. after a
+portal markup change, with --check.
+
+    ./benchmarks/bench_replay.py --record portal.json
+    ./benchmarks/bench_replay.py portal.json --save baseline.json
+    ./benchmarks/bench_replay.py portal.json --check baseline.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, _DIR)
+sys.path.insert(0, os.path.dirname(_DIR))
+import fake_portal  # noqa: E402 pylint: disable=wrong-import-position
+import mlss  # noqa: E402 pylint: disable=wrong-import-position
+
+_MLSS = os.path.join(os.path.dirname(_DIR), 'mlss.py')
+
+# mlss.py arguments recorded, and replayed as the full CLI flow
+FLOW = ['-l', '-p', '2249', '-c', 'shaper', '--down', '80', '--up', '80']
+
+
+def record(path):
+    """
+    Record the full CLI flow against the fake portal to a cassette
+    """
+    portal = fake_portal.FakePortal().start()
+    try:
+        _env = dict(os.environ,
+                    LAUNTEL_BASE_URL=portal.url,
+                    LAUNTEL_USERNAME=fake_portal.USERNAME,
+                    LAUNTEL_PASSWORD=fake_portal.PASSWORD)
+        subprocess.run([sys.executable, _MLSS, '--record', path] + FLOW,
+                       env=_env, stdin=subprocess.DEVNULL, check=True)
+    finally:
+        portal.stop()
+
+
+def extract_cases(cassette):
+    """
+    Return the page extraction cases of the recorded service and advanced
+    info pages
+    """
+    _cases = {}
+    for _entry in cassette.entries:
+        _path = _entry['url'].partition('?')[0]
+        if _path == '/service' and 'service' not in _cases:
+            _html = _entry['response']
+            _cases['service'] = lambda _html=_html: mlss.extract_page(
+                _html).service_dict()
+            _cases['speeds'] = lambda _html=_html: mlss.extract_page(
+                _html).speeds_dict()
+        elif _path == '/service_advanced' and 'shaper' not in _cases:
+            _html = _entry['response']
+            _cases['shaper'] = lambda _html=_html: mlss.extract_page(
+                _html, mlss._SHAPER_FIELDS).shaper_control()  # pylint: disable=protected-access
+    return _cases
+
+
+def client_cases(cassette):
+    """
+    Return the client call cases, each on a new client replaying the
+    cassette from the start
+    """
+    def case(call):
+        def run():
+            cassette.rewind()
+            _client = mlss.LauntelClient(
+                mlss._REDACTED, mlss._REDACTED,  # pylint: disable=protected-access
+                base_url='http://replay', cassette=cassette)
+            call(_client)
+            return _client.requests
+        return run
+
+    return {
+        'services': case(lambda _client: _client.get_services()),
+        'get_speeds': case(lambda _client: _client.get_speeds(latest=True)),
+        'get_shaper': case(lambda _client: _client.get_shaper()),
+        'change': case(lambda _client: (
+            _client.change_speed('2249', latest=True, commit=True),
+            _client.set_shaper(20, 200, commit=True),
+            _client.logout())),
+    }
+
+
+def run_cli(path):
+    """
+    Run the full CLI flow replaying the cassette, return the requests made
+    """
+    _proc = subprocess.run([sys.executable, _MLSS, '--stats', '--replay', path]
+                           + FLOW, stdin=subprocess.DEVNULL,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                           check=False)
+    for _line in _proc.stderr.decode('utf-8', 'replace').splitlines():
+        if 'requests made:' in _line:
+            return int(_line.split('requests made:')[1].split()[0])
+    sys.stderr.write(_proc.stderr.decode('utf-8', 'replace'))
+    return -1
+
+
+def measure(run, runs):
+    """
+    Return the median ms and the result of runs calls
+    """
+    _times = []
+    _result = None
+    for _ in range(runs):
+        _start = time.perf_counter()
+        _result = run()
+        _times.append((time.perf_counter() - _start) * 1000)
+    return statistics.median(_times), _result
+
+
+def check_results(results, baseline, tolerance):
+    """
+    Return a list of regressions against a saved baseline
+    """
+    _regressions = []
+    for _case, _result in results.items():
+        if _case not in baseline:
+            continue
+        _base = baseline[_case]
+        if _result['requests'] is not None and \
+                _result['requests'] > _base['requests']:
+            _regressions.append(
+                f'{_case}: requests {_base["requests"]} -> {_result["requests"]}')
+        if _result['ms'] > _base['ms'] * (1 + tolerance):
+            _regressions.append(
+                f'{_case}: {_base["ms"]:.3f}ms -> {_result["ms"]:.3f}ms')
+    return _regressions
+
+
+def main():
+    """
+    Benchmark each case replaying the cassette and print the results
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark mlss.py replaying a recorded portal cassette')
+    parser.add_argument('cassette', help='Cassette recorded with --record')
+    parser.add_argument('--record', action='store_true',
+                        help='Record the cassette from the fake portal first')
+    parser.add_argument('--runs', type=int, default=50,
+                        help='Runs per case, the median is reported')
+    parser.add_argument('--cli-runs', type=int, default=3,
+                        help='Runs of the full CLI flow')
+    parser.add_argument('--save', metavar='FILE',
+                        help='Save the results as a JSON baseline')
+    parser.add_argument('--check', metavar='FILE',
+                        help='Fail on regressions against a JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='Allowed time increase for --check')
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.cassette)
+    cassette = mlss.Cassette.load(args.cassette)
+    results = {}
+    print(f'{"CASE":12} {"MS":>9} {"REQUESTS":>9}')
+    _cases = [(_name, _run, args.runs) for _name, _run in
+              list(extract_cases(cassette).items()) +
+              list(client_cases(cassette).items())]
+    _cases.append(('cli', lambda: run_cli(args.cassette), args.cli_runs))
+    for _name, _run, _runs in _cases:
+        _ms, _result = measure(_run, _runs)
+        _requests = _result if isinstance(_result, int) else None
+        results[_name] = {'ms': _ms, 'requests': _requests}
+        print(f'{_name:12} {_ms:9.3f} '
+              f'{"" if _requests is None else _requests:>9}')
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as _file:
+            json.dump(results, _file, indent=2)
+    if args.check:
+        with open(args.check, encoding='utf-8') as _file:
+            _regressions = check_results(results, json.load(_file),
+                                         args.tolerance)
+        for _regression in _regressions:
+            print(f'REGRESSION {_regression}')
+        return 1 if _regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
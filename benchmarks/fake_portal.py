@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""
+Purpose: Local stand-in for the Launtel residential portal
+
+Serves realistic versions of the login, Services, modify service, confirm
+service, advanced info (form-shaping) and logout pages with configurable
+latency and error injection, gzip compression of pages for clients that
+accept it, and counts requests, connections and bytes.
+
+    ./benchmarks/fake_portal.py --port 8765 --latency 0.2
+    LAUNTEL_BASE_URL=http://127.0.0.1:8765 LAUNTEL_USERNAME=user \\
+        LAUNTEL_PASSWORD=password ./mlss.py
+"""
+import argparse
+import html
+import json
+import logging
+import random
+import secrets
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qsl
+from urllib.parse import urlencode
+from urllib.parse import urlparse
+
+USERNAME = 'user'
+PASSWORD = 'password'
+USERID = '10442'
+AVCID = 'AVC000123456789'
+
+# psid, name, current daily spend, latest daily spend, ntdupgrade
+PLANS = [
+    ('2241', 'Standby (0/0)', '0.30', '0.35', '0'),
+    ('2243', 'Basic (12/1)', '1.90', '1.95', '0'),
+    ('2244', 'Standard (25/5)', '2.25', '2.30', '0'),
+    ('2245', 'Standard (25/10)', '2.45', '2.50', '0'),
+    ('2246', 'Basic Fast (50/20)', '2.75', '2.80', '0'),
+    ('2247', 'Fast (100/20)', '3.00', '3.10', '0'),
+    ('2248', 'Fast (100/40)', '3.40', '3.50', '0'),
+    ('2249', 'Superfast (250/25)', '3.95', '4.10', '0'),
+    ('2250', 'Hyperfast (250/100)', '5.45', '5.60', '1'),
+    ('2251', 'Ultrafast (500/50)', '6.50', '6.70', '1'),
+    ('2252', 'Home Ultrafast (1000/50)', '9.50', '9.80', '1'),
+    ('2253', 'Home Hyperfast (1000/400)', '10.00', '10.50', '1'),
+]
+
+# Padding so page size and parse cost resemble the real portal
+_NAV = ''.join(
+    f'<li class="nav-item"><a class="nav-link" href="/{_item.lower()}">'
+    f'<i class="fa fa-{_item.lower()}"></i> {_item}</a></li>'
+    for _item in ['Dashboard', 'Services', 'Billing', 'Invoices', 'Payments',
+                  'Support', 'Account', 'Referrals'])
+_SCRIPT = '<script>' + ''.join(
+    f'function handler{_n}(e){{var el=document.getElementById("x{_n}");'
+    f'if(el){{el.classList.toggle("active");}}return false;}}\n'
+    for _n in range(120)) + '</script>'
+_FOOTER = '<footer class="footer"><div class="container">' + ''.join(
+    f'<p class="text-muted small">Terms and conditions clause {_n}. '
+    'Speeds are maximum line rates and actual speeds may vary.</p>'
+    for _n in range(40)) + '</div></footer>'
+
+
+def page(body, title='Launtel Residential'):
+    """
+    Wrap body in the portal layout
+    """
+    return ('<!DOCTYPE html><html lang="en"><head><meta charset="utf-8">'
+            f'<title>{title}</title><link rel="stylesheet" href="/css/app.css">'
+            f'{_SCRIPT}</head><body><nav class="navbar"><ul class="navbar-nav">'
+            f'{_NAV}<li class="nav-item"><a class="nav-link" '
+            'href="/logout_user">Sign Out</a></li></ul></nav>'
+            f'<main class="container">{body}</main>{_FOOTER}</body></html>')
+
+
+class FakePortal(ThreadingHTTPServer):
+    """
+    Fake Launtel portal server with latency, error injection and statistics
+    """
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0, error_rate=0.0,
+                 error_paths=(), change_delay=0.0, latest=True, seed=None,
+                 services=1):
+        super().__init__(address, FakePortalHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_paths = set(error_paths)
+        self.change_delay = change_delay
+        self.latest = latest
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.sessions = set()
+        self.avcids = [AVCID] + [f'AVC{900000000000 + _n:012d}'
+                                 for _n in range(1, services)]
+        self.psids = {_avcid: '2247' for _avcid in self.avcids}
+        self.pending = {}
+        self.shapers = {_avcid: {
+            'queue_type': 'shape',
+            'shaperdown_control': 'default',
+            'shaperdown_speed': '100',
+            'shaperup_control': 'default',
+            'shaperup_speed': '20',
+        } for _avcid in self.avcids}
+        self.stats = {}
+        self.reset_stats()
+        self._thread = None
+
+    @property
+    def url(self):
+        """
+        Base URL of the portal
+        """
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def reset_stats(self):
+        """
+        Reset the request statistics
+        """
+        with self.lock:
+            self.stats = {'requests': 0, 'connections': 0, 'bytes_sent': 0,
+                          'bytes_received': 0, 'errors': 0, 'logins': 0,
+                          'paths': {}}
+
+    def current_psid(self, avcid=AVCID):
+        """
+        Active psid of a service, a pending change takes effect after
+        change_delay
+        """
+        with self.lock:
+            _pending = self.pending.get(avcid)
+            if _pending is not None and time.monotonic() >= _pending[1]:
+                self.psids[avcid] = _pending[0]
+                del self.pending[avcid]
+            return self.psids[avcid]
+
+    def start(self):
+        """
+        Serve in a background thread
+        """
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving
+        """
+        self.shutdown()
+        self.server_close()
+
+
+class FakePortalHandler(BaseHTTPRequestHandler):
+    """
+    Fake Launtel portal request handler
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    server: FakePortal
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.stats['connections'] += 1
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logging.debug('fake portal: ' + format, *args)
+
+    def _session(self):
+        for _cookie in self.headers.get('Cookie', '').split(';'):
+            _name, _, _value = _cookie.strip().partition('=')
+            if _name == 'session_id' and _value in self.server.sessions:
+                return _value
+        return None
+
+    def _send(self, status, body='', headers=()):
+        _body = body.encode('utf-8')
+        _gzip = 'gzip' in self.headers.get('Accept-Encoding', '') and _body
+        if _gzip:
+            _compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+            _body = _compressor.compress(_body) + _compressor.flush()
+        self.send_response(status)
+        for _name, _value in headers:
+            self.send_header(_name, _value)
+        if _gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(_body)))
+        self.end_headers()
+        self.wfile.write(_body)
+        with self.server.lock:
+            self.server.stats['bytes_sent'] += len(_body)
+
+    def _redirect(self, location, headers=()):
+        self._send(302, '', [('Location', location)] + list(headers))
+
+    def _begin(self):
+        """
+        Count the request, apply latency and error injection, return False
+        if an error was injected
+        """
+        _path = urlparse(self.path).path
+        with self.server.lock:
+            self.server.stats['requests'] += 1
+            self.server.stats['bytes_received'] += int(
+                self.headers.get('Content-Length') or 0)
+            _paths = self.server.stats['paths']
+            _paths[_path] = _paths.get(_path, 0) + 1
+            _error = (_path in self.server.error_paths or
+                      self.server.random.random() < self.server.error_rate)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if _error:
+            with self.server.lock:
+                self.server.stats['errors'] += 1
+            self._send(503, page('<h1>Service Unavailable</h1>'))
+            return False
+        return True
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Serve portal pages
+        """
+        if not self._begin():
+            return
+        _url = urlparse(self.path)
+        _query = dict(parse_qsl(_url.query))
+        if _url.path == '/__stats':
+            self._send(200, json.dumps(self.server.stats))
+            return
+        if _url.path == '/login':
+            self._send(200, login_page())
+            return
+        if _url.path == '/logout_user':
+            self.server.sessions.discard(self._session())
+            self._redirect('/login')
+            return
+        if self._session() is None:
+            self._redirect('/login')
+            return
+        _avcid = _query.get('avcid', AVCID)
+        if _avcid not in self.server.psids:
+            self._send(404, page('<h1>Not Found</h1>'))
+            return
+        if _url.path in ('/', '/dashboard'):
+            self._send(200, dashboard_page())
+        elif _url.path == '/services':
+            self._send(200, services_page(self.server.avcids))
+        elif _url.path == '/service':
+            _latest = _query.get('latest') == '1' and self.server.latest
+            self._send(200, service_page(self.server.current_psid(_avcid),
+                                         _latest, self.server.latest, _avcid))
+        elif _url.path == '/confirm_service':
+            self._send(200, confirm_page(_query))
+        elif _url.path == '/service_advanced':
+            self._send(200, advanced_page(self.server.shapers[_avcid],
+                                          self.server.current_psid(_avcid),
+                                          _avcid))
+        else:
+            self._send(404, page('<h1>Not Found</h1>'))
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """
+        Handle login, confirm service and shaping form posts
+        """
+        _length = int(self.headers.get('Content-Length') or 0)
+        _data = dict(parse_qsl(self.rfile.read(_length).decode('utf-8')))
+        if not self._begin():
+            return
+        _url = urlparse(self.path)
+        if _url.path == '/login':
+            if _data.get('username') == USERNAME and \
+                    _data.get('password') == PASSWORD:
+                _session = secrets.token_hex(16)
+                with self.server.lock:
+                    self.server.sessions.add(_session)
+                    self.server.stats['logins'] += 1
+                self._redirect('/', [(
+                    'Set-Cookie', f'session_id={_session}; Path=/; HttpOnly')])
+            else:
+                self._send(200, login_page('Sorry incorrect login details'))
+            return
+        if self._session() is None:
+            self._redirect('/login')
+            return
+        _avcid = dict(parse_qsl(_url.query)).get('avcid',
+                                                 _data.get('avcid', AVCID))
+        if _avcid not in self.server.psids:
+            self._send(404, page('<h1>Not Found</h1>'))
+            return
+        if _url.path == '/confirm_service':
+            with self.server.lock:
+                self.server.pending[_avcid] = (
+                    _data.get('psid'),
+                    time.monotonic() + self.server.change_delay)
+            self.server.current_psid(_avcid)
+            self._send(200, page(
+                '<dl class="service-dl"><dt>Status</dt>'
+                '<dd>Change in progress</dd></dl>'))
+        elif _url.path == '/shaping':
+            with self.server.lock:
+                _shaper = self.server.shapers[_avcid]
+                for _key in _shaper:
+                    if _key in _data:
+                        _shaper[_key] = _data[_key]
+            self._send(200, page(
+                '<div class="alert alert-success"><div class="alert-content">'
+                'Shaping settings updated - may take a minute to take effect'
+                '</div></div>'))
+        else:
+            self._send(404, page('<h1>Not Found</h1>'))
+
+
+def login_page(alert='Please sign in'):
+    """
+    Login page
+    """
+    return page(
+        f'<div class="alert"><div class="alert-content">{alert}</div></div>'
+        '<form id="login-form" method="post" action="/login">'
+        '<input type="text" name="username" class="form-control">'
+        '<input type="password" name="password" class="form-control">'
+        '<button type="submit" class="btn btn-primary">Sign In</button>'
+        '</form>', 'Sign In')
+
+
+def dashboard_page():
+    """
+    Landing page after login
+    """
+    return page('<div class="alert"><div class="alert-content">'
+                'Welcome back</div></div><h1>Dashboard</h1>'
+                '<a href="/services">Services</a>')
+
+
+def services_page(avcids=(AVCID,)):
+    """
+    Services page with a card and Show Advanced Info link per service
+    """
+    _cards = ''
+    for _avcid in avcids:
+        _query = urlencode({'userid': USERID, 'avcid': _avcid})
+        _cards += (
+            '<div class="card"><dl class="service-dl">'
+            '<dt>Status</dt><dd>Active</dd><dt>Service</dt><dd>nbn FTTP</dd>'
+            f'</dl><a class="btn" href="/service?{_query}">Modify Service</a>'
+            f'<a class="btn" href="/service_advanced?{_query}">'
+            'Show Advanced Info</a></div>')
+    return page(f'<h1>Services</h1>{_cards}')
+
+
+def service_page(psid, latest, has_latest, avcid=AVCID):
+    """
+    Modify service page with the manage_service form and plan spans
+    """
+    _plans = ''.join(
+        f'<span class="list-group-item" data-value="{_psid}" '
+        f'data-plancharge="{_latest if latest else _current}" '
+        f'data-ntdupgrade="{_ntd}"><div class="row">'
+        f'<div class="col-sm-4">\n\t\t{html.escape(_name)}[1]\n\t</div>'
+        f'<div class="col-sm-4">${_latest if latest else _current}/day</div>'
+        '</div></span>'
+        for _psid, _name, _current, _latest, _ntd in PLANS)
+    _button = ('<button class="btn" onclick="showLatest()">'
+               'Show Latest Pricing Options</button>' if has_latest else '')
+    return page(
+        f'<h1>Modify Service</h1>{_button}'
+        '<form name="manage_service" method="post" action="/service">'
+        f'<input type="hidden" name="userid" value="{USERID}">'
+        f'<input type="hidden" name="psid" value="{psid}">'
+        '<input type="hidden" name="unpause" value="0">'
+        '<input type="hidden" name="service_id" value="88231">'
+        f'<input type="hidden" name="avcid" value="{avcid}">'
+        '<input type="hidden" name="locid" value="LOC000987654321">'
+        '<input type="hidden" name="coat" value="0">'
+        '<span class="rollover list-group-item" value="0">'
+        'Rollover options</span>'
+        f'<div class="list-group">{_plans}</div></form>')
+
+
+def confirm_page(query):
+    """
+    Confirm service page with the confirm_service form
+    """
+    _inputs = ''.join(
+        f'<input type="hidden" name="{html.escape(_name)}" '
+        f'value="{html.escape(_value)}">' for _name, _value in query.items())
+    return page(
+        '<h1>Confirm Service Change</h1>'
+        '<form name="confirm_service" method="post" action="/confirm_service">'
+        f'{_inputs}<button type="submit">Looks great - update it!</button>'
+        '</form>')
+
+
+def advanced_page(shaper, psid, avcid=AVCID):
+    """
+    Advanced info page with the form-shaping form
+    """
+    _down, _up = [int(_speed) for _speed in
+                  dict((_p[0], _p[1]) for _p in PLANS)[psid]
+                  .split('(')[1].rstrip(')').split('/')]
+
+    def radios(name, checked):
+        return ''.join(
+            f'<input type="radio" name="{name}" id="{name}_{_option}" '
+            f'value="{_option}"{" checked" if _option == checked else ""}>'
+            f'<label for="{name}_{_option}">{_option}</label>'
+            for _option in ['none', 'default', 'override'])
+
+    def queue(q_type):
+        _checked = ' checked' if shaper['queue_type'] == q_type else ''
+        return (f'<input type="radio" name="queue_type" value="{q_type}"'
+                f'{_checked}>')
+
+    return page(
+        '<h1>Advanced Info</h1>'
+        f'<form name="form-shaping" method="post" action="/shaping?avcid={avcid}">'
+        f'{queue("shape")}{queue("police")}'
+        f'{radios("shaperdown_control", shaper["shaperdown_control"])}'
+        f'<input type="number" id="shaperdown_speed" name="shaperdown_speed" '
+        f'min="{max(1, _down // 2)}" max="{_down * 2}" '
+        f'value="{shaper["shaperdown_speed"]}">'
+        f'{radios("shaperup_control", shaper["shaperup_control"])}'
+        f'<input type="number" id="shaperup_speed" name="shaperup_speed" '
+        f'min="{max(1, _up // 2)}" max="{_up * 2}" '
+        f'value="{shaper["shaperup_speed"]}">'
+        '<button type="submit">Save</button></form>')
+
+
+def main():
+    """
+    Run the fake portal until interrupted
+    """
+    parser = argparse.ArgumentParser(description='Fake Launtel portal')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every request')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of requests answered with a 503')
+    parser.add_argument('--error-path', action='append', default=[],
+                        help='Path always answered with a 503')
+    parser.add_argument('--change-delay', type=float, default=0.0,
+                        help='Seconds before a speed change takes effect')
+    parser.add_argument('--no-latest', action='store_true',
+                        help='Do not offer latest pricing options')
+    parser.add_argument('--services', type=int, default=1,
+                        help='Services on the account')
+    args = parser.parse_args()
+    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+    portal = FakePortal((args.host, args.port), args.latency, args.error_rate,
+                        args.error_path, args.change_delay,
+                        not args.no_latest, services=args.services)
+    logging.info('Fake portal at %s, login %s / %s', portal.url, USERNAME,
+                 PASSWORD)
+    try:
+        portal.serve_forever()
+    except KeyboardInterrupt:
+        portal.server_close()
+
+
+if __name__ == '__main__':
+    main()
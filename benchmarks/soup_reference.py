@@ -0,0 +1,146 @@
+"""
+Purpose: BeautifulSoup reference implementation of the Launtel page parsing,
+kept to check and benchmark the single pass PageExtractor against
+"""
+
+
+def get_queue_type(soup):
+    """
+    Get active shaper queue type
+    """
+    queue_types = ['shape', 'police']
+    for q_type in queue_types:
+        attrs = {'name': 'queue_type', 'value': q_type}
+        if soup.find('input', attrs=attrs).get('checked') is not None:
+            return q_type
+    return None
+
+
+def get_shaper_control_option(soup, control_name, options):
+    """
+    Get shaper control options
+    """
+    control_option = None
+    for option in options:
+        attrs = {'name': control_name, 'id': f'{control_name}_{option}'}
+        if soup.find('input', attrs=attrs).get('checked') is not None:
+            control_option = option
+    return control_option
+
+
+def get_shaper_input_attribute(soup, input_id, attribute):
+    """
+    Get attribute from input element.
+    """
+    return soup.find('input', attrs={'id': input_id}).get(attribute)
+
+
+def get_shaper_control(soup):
+    """
+    Get shaper control info
+    """
+    queue_type = get_queue_type(soup)
+    shaperdown_control = get_shaper_control_option(
+        soup, 'shaperdown_control', ['none', 'default', 'override'])
+    shaperup_control = get_shaper_control_option(
+        soup, 'shaperup_control', ['none', 'default', 'override'])
+
+    shaperdown_max = get_shaper_input_attribute(
+        soup, 'shaperdown_speed', 'max')
+    shaperdown_min = get_shaper_input_attribute(
+        soup, 'shaperdown_speed', 'min')
+    shaperdown_speed_value = get_shaper_input_attribute(
+        soup, 'shaperdown_speed', 'value')
+
+    shaperup_max = get_shaper_input_attribute(soup, 'shaperup_speed', 'max')
+    shaperup_min = get_shaper_input_attribute(soup, 'shaperup_speed', 'min')
+    shaperup_speed_value = get_shaper_input_attribute(
+        soup, 'shaperup_speed', 'value')
+
+    shaper_control_url = soup.find(
+        'form', attrs={'name': 'form-shaping'}).get('action')
+
+    shaper_dict = {
+        'queue_type': queue_type,
+        'shaperdown_cont': shaperdown_control,
+        'shaperdown_control': shaperdown_control,
+        'shaperdown_speed': shaperdown_speed_value,
+        'shaperup_cont': shaperup_control,
+        'shaperup_control': shaperup_control,
+        'shaperup_speed': shaperup_speed_value,
+        'shaperdown_max': shaperdown_max,
+        'shaperdown_min': shaperdown_min,
+        'shaperup_max': shaperup_max,
+        'shaperup_min': shaperup_min,
+        'shaper_control_url': shaper_control_url,
+    }
+
+    return shaper_dict
+
+
+def get_speeds_dict(soup):
+    """
+    Get a dict of speeds sorted by spend
+    """
+    _speeds = soup.find_all(
+        'span', attrs={'data-value': True})
+    _speeds_dict = {}
+
+    for speed in _speeds:
+        _speed_name = speed.find(
+            'div', attrs={
+                'class': 'col-sm-4'}).text.strip()
+        _speed_psid = speed.get('data-value')
+        _speed_daily_spend = speed.get('data-plancharge')
+        _speed_ntdupgrade = speed.get('data-ntdupgrade')
+        _speeds_dict[_speed_psid] = {
+            'name': _speed_name.replace('\t', '').replace('\n', '').replace('[1]', ''),
+            'spend': _speed_daily_spend,
+            'ntdupgrade': _speed_ntdupgrade,
+        }
+    # Sort the dictionary by spend value
+    _sorted_speeds_dict = dict(
+        sorted(_speeds_dict.items(), key=lambda x: float(x[1]['spend']))
+    )
+
+    return _sorted_speeds_dict
+
+
+def get_service_dict(soup):
+    """
+    Get a dict of the service
+    """
+    # Find all the values utilised within Launtels service modification
+    # and necessary for next services of validations and script steps
+    _userid = soup.find(
+        'input', attrs={'name': 'userid'}).get('value')
+    _c_psid = soup.find(
+        'input', attrs={'name': 'psid'}).get('value')
+    _unpause = soup.find(
+        'input', attrs={'name': 'unpause'}).get('value')
+    _service_id = soup.find(
+        'input', attrs={
+            'name': 'service_id'}).get('value')
+    _upgrade_options = soup.find(
+        'span', attrs={'class': 'rollover list-group-item'}).get('value')
+    _discount_code = ''  # /check_discount/0/{_AVCID}/
+    _avcid = soup.find(
+        'input', attrs={'name': 'avcid'}).get('value')
+    _locid = soup.find(
+        'input', attrs={'name': 'locid'}).get('value')
+    _coat = soup.find('input', attrs={'name': 'coat'}).get('value')
+    _churn = soup.find('input', attrs={'name': 'coat'}).get('value')
+
+    _service_dict = {}
+    _service_dict[_avcid] = {
+        'userid': _userid,
+        'psid': _c_psid,
+        'unpause': _unpause,
+        'service_id': _service_id,
+        'upgrade_options': _upgrade_options,
+        'discount_code': _discount_code,
+        'locid': _locid,
+        'coat': _coat,
+        'churn': _churn}
+
+    return _service_dict
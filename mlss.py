@@ -1,70 +1,1775 @@
 #!/usr/bin/env python3
 """
 Purpose: Script for Launtel Speed Info and Change
+
+The LauntelClient class can also be imported to run many operations on a
+single portal session, the command line interface is a thin wrapper around it.
 """
 import argparse
+import bisect
 import getpass
 import logging
 import sys
 import signal
 import os
 import re
+import json
+import time
+import threading
+import codecs
+import datetime
+import functools
+from contextlib import contextmanager
+from html.parser import HTMLParser
+from dataclasses import asdict
+from dataclasses import dataclass
+from dataclasses import fields
+from dataclasses import replace
+from typing import Optional
 from urllib.parse import urlencode
 from urllib.parse import urlparse
 from urllib.parse import parse_qs
-from dotenv import load_dotenv
-from bs4 import BeautifulSoup
-from mechanize import Browser
-from mechanize import Link
-from rich import box
-from rich.table import Table
-from rich.console import Console
+from urllib.parse import parse_qsl
+from urllib.parse import urljoin
+# dotenv, mechanize and rich are imported where they are used, so --help,
+# cached and non-interactive runs don't pay for them at startup
 
 _USERNAME = ''
 _PASSWORD = ''
 
-_BASE_URL = 'https://residential.launtel.net.au'
-_LOGIN_URL = f'{_BASE_URL}/login'
-_SIGNOUT_URL = f'{_BASE_URL}/logout_user'
-_MODIFY_SERVICE_URL = f'{_BASE_URL}/service'
+_BASE_URL = os.getenv('LAUNTEL_BASE_URL',
+                      'https://residential.launtel.net.au')
 _ISP = "Launtel"
-_LOGIN_SUCCESSFUL = False
-_COMPLETE = False
-
-_COMMIT = False
-_LATEST = False
-_SHAPER = False
-_PSID_VALID = False
-_PSID = ''
-_UP = ''
-_DOWN = ''
 _SHAPER_CONTROL_OPTION = "override"
+_PLAN_SPEED = re.compile(r'\((\d+)/(\d+)\)')
+_SHAPER_CONTROLS = ['none', 'default', 'override']
+_TIMEOUT = 30.0
+_RETRIES = 2
+_REDACTED = 'REDACTED'
+_CASSETTE_FIELDS = ('username', 'password')
+_SERVE_MAX_BODY = 65536
+_SPOOL_POLL = 0.5
+_SERVE_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+                  405: 'Method Not Allowed', 413: 'Payload Too Large',
+                  500: 'Internal Server Error', 502: 'Bad Gateway'}
+_CASSETTE_SKIP_HEADERS = ('content-length', 'content-encoding',
+                          'transfer-encoding', 'connection', 'date')
+_WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+_SERVICE_FIELDS = ['userid', 'psid', 'unpause', 'service_id', 'avcid',
+                   'locid', 'coat']
+# Shaper page keys, parsing stops once all of them have been seen
+_SHAPER_FIELDS = (['queue_type=shape', 'queue_type=police',
+                   'shaperdown_speed', 'shaperup_speed', 'form-shaping'] +
+                  [f'shaperdown_control_{_option}'
+                   for _option in _SHAPER_CONTROLS] +
+                  [f'shaperup_control_{_option}'
+                   for _option in _SHAPER_CONTROLS])
+
+_CLIENT = None
+_SIGN_OUT = True
+
+
+class LauntelError(Exception):
+    """
+    Raised when the Launtel portal rejects or fails an operation
+    """
+
+
+class InvalidChange(LauntelError):
+    """
+    Raised when a requested psid or shaper speeds are not valid for the
+    service
+    """
+
+
+@dataclass
+class Service:
+    """
+    Service values used by Launtel's service modification
+    """
+    avcid: str
+    userid: str
+    psid: str
+    unpause: str
+    service_id: str
+    upgrade_options: str
+    discount_code: str
+    locid: str
+    coat: str
+    churn: str
+
+
+@dataclass
+class Plan:
+    """
+    Speed plan offered for a service, with the daily spend and the down/up
+    Mbps from the plan name parsed once, None if the name has no speeds
+    (or ntdupgrade if the portal doesn't say)
+    """
+    __slots__ = ('psid', 'name', 'spend', 'ntdupgrade', 'down', 'up')
+    psid: str
+    name: str
+    spend: float
+    ntdupgrade: Optional[bool]
+    down: Optional[int]
+    up: Optional[int]
+
+    @classmethod
+    def parse(cls, psid, name, spend, ntdupgrade):
+        """
+        Create a Plan from the portal's string values
+        """
+        _speed = _PLAN_SPEED.search(name)
+        return cls(psid=psid, name=name, spend=float(spend),
+                   ntdupgrade=None if ntdupgrade in ('', None)
+                   else bool(int(ntdupgrade)),
+                   down=int(_speed.group(1)) if _speed else None,
+                   up=int(_speed.group(2)) if _speed else None)
+
+
+class Speeds(dict):
+    """
+    Plan catalog, a dict of PSID to Plan ordered by spend, indexed by down
+    speed for the cheapest plan lookup
+    """
+
+    def __init__(self, plans=()):
+        super().__init__(
+            (_plan.psid, _plan)
+            for _plan in sorted(plans, key=lambda _plan: _plan.spend))
+        _by_down = sorted((_plan for _plan in self.values()
+                           if _plan.down is not None),
+                          key=lambda _plan: _plan.down)
+        self._downs = [_plan.down for _plan in _by_down]
+        # _cheapest[i] is the cheapest plan of _by_down[i:]
+        self._cheapest = _by_down[:]
+        for _i in range(len(_by_down) - 2, -1, -1):
+            if self._cheapest[_i + 1].spend < self._cheapest[_i].spend:
+                self._cheapest[_i] = self._cheapest[_i + 1]
+
+    @classmethod
+    def parse(cls, speeds_dict):
+        """
+        Create the catalog from a speeds dict of PSID to string values
+        """
+        return cls(Plan.parse(_psid, **_values)
+                   for _psid, _values in speeds_dict.items())
+
+    def cheapest(self, min_down=0):
+        """
+        Return the cheapest plan with at least min_down Mbps down, None if
+        there isn't one
+        """
+        _i = bisect.bisect_left(self._downs, min_down)
+        return self._cheapest[_i] if _i < len(self._cheapest) else None
+
+
+@dataclass
+class Shaper:
+    """
+    Shaper control settings of a service
+    """
+    queue_type: str
+    shaperdown_control: str
+    shaperdown_speed: str
+    shaperdown_max: str
+    shaperdown_min: str
+    shaperup_control: str
+    shaperup_speed: str
+    shaperup_max: str
+    shaperup_min: str
+    shaper_control_url: str
+
+
+class Tracer:
+    """
+    Record phase spans, HTTP requests and parse times as JSON lines, a no-op
+    without a path
+    """
 
-_SHAPER_DICT = {}
-_SERVICE_DICT = {}
-_SPEEDS_DICT = {}
-_USERID = ''
-_AVCID = ''
-_C_PSID = ''
-_UNPAUSE = ''
-_SERVICE_ID = ''
-_UPGRADE_OPTIONS = ''
-_DISCOUNT_CODE = ''
-_LOCID = ''
-_COAT = ''
-_NTD = False
+    def __init__(self, path=None):
+        self.path = path
+        self._file = None
+        self._spans = []
+        if path is not None:
+            self._file = open(path, 'a', encoding='utf-8')  # pylint: disable=consider-using-with
+
+    @property
+    def current(self):
+        """
+        Name of the innermost open span
+        """
+        return self._spans[-1] if self._spans else None
+
+    def record(self, kind, **fields):
+        """
+        Write a trace record
+        """
+        if self._file is None:
+            return
+        _record = {'type': kind, 'time': round(time.time(), 6),
+                   'span': self.current}
+        _record.update(fields)
+        self._file.write(json.dumps(_record) + '\n')
+        self._file.flush()
+
+    @contextmanager
+    def span(self, name, **fields):
+        """
+        Record the duration of the with block as a span
+        """
+        _parent = self.current
+        self._spans.append(name)
+        _started = time.perf_counter()
+        _error = None
+        try:
+            yield
+        except Exception as err:
+            _error = repr(err)
+            raise
+        finally:
+            self._spans.pop()
+            if self._file is not None:
+                self.record('span', name=name, parent=_parent,
+                            ms=round((time.perf_counter() - _started) * 1000, 3),
+                            error=_error, **fields)
+
+    def close(self):
+        """
+        Close the trace file
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def traced(name):
+    """
+    Decorator recording a LauntelClient method call as a trace span
+    """
+    def _decorator(method):
+        @functools.wraps(method)
+        def _wrapper(self, *args, **kwargs):
+            with self.tracer.span(name):
+                return method(self, *args, **kwargs)
+        return _wrapper
+    return _decorator
+
+
+class RequestCounter:
+    """
+    mechanize handler counting every HTTP request made by the browser,
+    including redirects, and tracing their status, bytes and latency
+    """
+    handler_order = 500
+
+    def __init__(self, tracer=None):
+        self.requests = 0
+        self.parent = None
+        self.tracer = tracer if tracer is not None else Tracer()
+
+    def __lt__(self, other):
+        return self.handler_order < getattr(other, 'handler_order', sys.maxsize)
+
+    def add_parent(self, parent):
+        """
+        Set the opener this handler was added to
+        """
+        self.parent = parent
+
+    def close(self):
+        """
+        Nothing to close
+        """
+
+    def http_request(self, request):
+        """
+        Count the request
+        """
+        self.requests += 1
+        request.trace_started = time.perf_counter()
+        return request
+
+    def http_response(self, request, response):
+        """
+        Trace the response
+        """
+        _started = getattr(request, 'trace_started', None)
+        if _started is not None:
+            _length = response.info().get('Content-Length')
+            self.tracer.record(
+                'http', method=request.get_method(),
+                path=urlparse(request.get_full_url()).path,
+                status=response.code,
+                bytes=int(_length) if _length is not None else None,
+                ms=round((time.perf_counter() - _started) * 1000, 3))
+        return response
+
+    https_request = http_request
+    https_response = http_response
+
+
+class Cassette:
+    """
+    mechanize handler recording every request and decoded response to a
+    JSON cassette, with the credentials and session cookies replaced by
+    REDACTED, or replaying a cassette from memory without the network
+    """
+    handler_order = 100
+
+    def __init__(self, path, replaying=False, secrets=()):
+        self.path = path
+        self.replaying = replaying
+        self.secrets = {_secret for _secret in secrets if _secret}
+        self.entries = []
+        self.parent = None
+        self._lock = threading.Lock()
+        self._queues = {}
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a cassette for replay
+        """
+        try:
+            with open(path, encoding='utf-8') as _file:
+                _entries = json.load(_file)['entries']
+        except (OSError, ValueError, KeyError) as err:
+            raise LauntelError(f'Cassette {path} not loaded: {err}') from err
+        _cassette = cls(path, replaying=True)
+        _cassette.entries = _entries
+        _cassette.rewind()
+        return _cassette
+
+    def rewind(self):
+        """
+        Replay the cassette again from its first response
+        """
+        with self._lock:
+            self._queues = {}
+            for _entry in self.entries:
+                self._queues.setdefault(
+                    (_entry['method'], _entry['url']), []).append(_entry)
+
+    def save(self):
+        """
+        Write the recorded entries to the cassette file
+        """
+        with self._lock:
+            with open(self.path, 'w', encoding='utf-8') as _file:
+                json.dump({'version': 1, 'entries': self.entries}, _file,
+                          indent=1)
+        logging.debug('Cassette of %s requests saved to %s.',
+                      len(self.entries), self.path)
+
+    def __lt__(self, other):
+        return self.handler_order < getattr(other, 'handler_order', sys.maxsize)
+
+    def add_parent(self, parent):
+        """
+        Set the opener this handler was added to
+        """
+        self.parent = parent
+
+    def close(self):
+        """
+        Nothing to close
+        """
+
+    def sanitize(self, text):
+        """
+        Replace whole occurrences of the secrets, raw, form and HTML
+        encoded, with REDACTED
+        """
+        import html  # pylint: disable=import-outside-toplevel
+        from urllib.parse import quote_plus  # pylint: disable=import-outside-toplevel
+        for _secret in self.secrets:
+            for _form in {_secret, quote_plus(_secret), html.escape(_secret)}:
+                text = re.sub(rf'(?<![\w.@%-]){re.escape(_form)}(?![\w.@%-])',
+                              _REDACTED, text)
+        return text
+
+    @staticmethod
+    def _key(request):
+        """
+        Method and URL, without scheme and host, a request is matched by
+        """
+        _url = urlparse(request.get_full_url())
+        return (request.get_method(),
+                f'{_url.path}?{_url.query}' if _url.query else _url.path)
+
+    def _sanitize_body(self, data):
+        """
+        Sanitize a form request body, removing the credential fields
+        """
+        if not data:
+            return ''
+        if isinstance(data, bytes):
+            data = data.decode('utf-8', 'replace')
+        _fields = parse_qsl(data, keep_blank_values=True)
+        return self.sanitize(urlencode([
+            (_name, _REDACTED if _name in _CASSETTE_FIELDS else _value)
+            for _name, _value in _fields]))
+
+    def _sanitize_header(self, name, value):
+        """
+        Sanitize a response header, keeping only the name of cookies set
+        """
+        if name.lower() == 'set-cookie':
+            _cookie, _, _attributes = value.partition(';')
+            _name, _, _value = _cookie.partition('=')
+            _value = _value.strip()
+            # A cleared cookie has no value to redact, and an empty secret
+            # would match everywhere
+            if _value != '':
+                self.secrets.add(_value)
+                _value = _REDACTED
+            return f'{_name}={_value};{_attributes}' if _attributes \
+                else f'{_name}={_value}'
+        return self.sanitize(value)
+
+    def http_open(self, request):
+        """
+        Return the next recorded response to the request when replaying
+        """
+        if self.replaying is False:
+            return None
+        import http.client  # pylint: disable=import-outside-toplevel
+        import io  # pylint: disable=import-outside-toplevel
+        from mechanize import HTTPError  # pylint: disable=import-outside-toplevel
+        from mechanize._response import closeable_response  # pylint: disable=import-outside-toplevel
+        _key = self._key(request)
+        with self._lock:
+            _queue = self._queues.get(_key)
+            if not _queue:
+                raise HTTPError(request.get_full_url(), 404,
+                                f'{_key[0]} {_key[1]} not in cassette',
+                                http.client.HTTPMessage(), None)
+            # the last response to a URL is repeated, e.g. when polling
+            _entry = _queue.pop(0) if len(_queue) > 1 else _queue[0]
+        _headers = http.client.HTTPMessage()
+        for _name, _value in _entry['headers']:
+            _headers[_name] = _value
+        _body = _entry['response'].encode('utf-8')
+        _headers['Content-Length'] = str(len(_body))
+        return closeable_response(io.BytesIO(_body), _headers,
+                                  request.get_full_url(), _entry['status'],
+                                  _entry['reason'])
+
+    def http_response(self, request, response):
+        """
+        Record the sanitized request and response when recording
+        """
+        if self.replaying is True:
+            return response
+        import io  # pylint: disable=import-outside-toplevel
+        from mechanize._response import closeable_response  # pylint: disable=import-outside-toplevel
+        _body = response.read()
+        _method, _url = self._key(request)
+        _headers = [[_name, self._sanitize_header(_name, _value)]
+                    for _name, _value in response.info().items()
+                    if _name.lower() not in _CASSETTE_SKIP_HEADERS]
+        _entry = {'method': _method,
+                  'url': self.sanitize(_url),
+                  'body': self._sanitize_body(request.data),
+                  'status': response.code,
+                  'reason': response.msg,
+                  'headers': _headers,
+                  'response': self.sanitize(_body.decode('utf-8', 'replace'))}
+        with self._lock:
+            self.entries.append(_entry)
+        return closeable_response(io.BytesIO(_body), response.info(),
+                                  response.geturl(), response.code,
+                                  response.msg)
+
+    https_open = http_open
+    https_response = http_response
+
+
+class ExtractionDone(Exception):
+    """
+    Raised by PageExtractor to stop parsing once the wanted fields are found
+    """
+
+
+class PageExtractor(HTMLParser):
+    """
+    Collect the input, span[data-value], form, link and status text of a
+    portal page in a single streaming pass, stopping early once every
+    wanted key (input name, id or name=value and form name) has been seen
+    """
+    _TEXT_CLASSES = {('div', 'alert-content'), ('dl', 'service-dl')}
+
+    def __init__(self, wanted=()):
+        super().__init__(convert_charrefs=True)
+        self.bytes = 0
+        self.inputs = []
+        self.forms = {}
+        self.plans = []
+        self.rollover = None
+        self.links = []
+        self.text = {'alert-content': [], 'service-dl': []}
+        self._wanted = set(wanted)
+        self._plan = None
+        self._plan_depth = 0
+        self._captures = []
+
+    def _seen(self, *keys):
+        """
+        Mark keys as seen and stop when nothing wanted is left
+        """
+        if self._wanted:
+            self._wanted.difference_update(keys)
+            if not self._wanted:
+                raise ExtractionDone()
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        _classes = (attrs.get('class') or '').split()
+        for _capture in self._captures:
+            if _capture[0] == tag:
+                _capture[1] += 1
+        if tag == 'input':
+            self.inputs.append(attrs)
+            _name = attrs.get('name')
+            self._seen(_name, attrs.get('id'),
+                       f'{_name}={attrs.get("value")}')
+        elif tag == 'form':
+            _name = attrs.get('name') or attrs.get('id')
+            self.forms.setdefault(_name, attrs)
+            self._seen(_name)
+        elif tag == 'span':
+            if self._plan is not None:
+                self._plan_depth += 1
+            elif 'data-value' in attrs:
+                self._plan = {'psid': attrs.get('data-value'),
+                              'name': None,
+                              'spend': attrs.get('data-plancharge'),
+                              'ntdupgrade': attrs.get('data-ntdupgrade')}
+                self._plan_depth = 1
+            elif self.rollover is None and \
+                    _classes == ['rollover', 'list-group-item']:
+                self.rollover = attrs
+        elif tag == 'div' and 'col-sm-4' in _classes and \
+                self._plan is not None and self._plan['name'] is None:
+            self._captures.append([tag, 1, 'plan-name', []])
+        elif tag == 'a' and 'href' in attrs:
+            self._captures.append([tag, 1, 'link', [], attrs['href']])
+        for _tag, _class in self._TEXT_CLASSES:
+            if tag == _tag and _class in _classes:
+                self._captures.append([tag, 1, _class, []])
+
+    def handle_endtag(self, tag):
+        for _capture in list(self._captures):
+            if _capture[0] != tag:
+                continue
+            _capture[1] -= 1
+            if _capture[1] == 0:
+                self._captures.remove(_capture)
+                _text = ''.join(_capture[3]).strip()
+                if _capture[2] == 'plan-name':
+                    self._plan['name'] = _text
+                elif _capture[2] == 'link':
+                    self.links.append((_text, _capture[4]))
+                else:
+                    self.text[_capture[2]].append(_text)
+        if tag == 'span' and self._plan is not None:
+            self._plan_depth -= 1
+            if self._plan_depth == 0:
+                self.plans.append(self._plan)
+                self._plan = None
+
+    def handle_data(self, data):
+        for _capture in self._captures:
+            _capture[3].append(data)
+
+    def find_input(self, field, **attrs):
+        """
+        Return the first input matching attrs, field names it in errors
+        """
+        for _input in self.inputs:
+            if all(_input.get(_key) == _value
+                   for _key, _value in attrs.items()):
+                return _input
+        raise LauntelError(f'{_ISP} page field {field} not found.')
+
+    def service_dict(self):
+        """
+        Get a dict of the service, as soup_reference.get_service_dict
+        """
+        _values = {_field: self.find_input(_field, name=_field).get('value')
+                   for _field in _SERVICE_FIELDS}
+        if self.rollover is None:
+            raise LauntelError(f'{_ISP} page field upgrade_options not found.')
+        _avcid = _values.pop('avcid')
+        return {_avcid: {
+            'userid': _values['userid'],
+            'psid': _values['psid'],
+            'unpause': _values['unpause'],
+            'service_id': _values['service_id'],
+            'upgrade_options': self.rollover.get('value'),
+            'discount_code': '',  # /check_discount/0/{_AVCID}/
+            'locid': _values['locid'],
+            'coat': _values['coat'],
+            'churn': _values['coat']}}
+
+    def speeds_dict(self):
+        """
+        Get a dict of speeds sorted by spend, as
+        soup_reference.get_speeds_dict
+        """
+        _speeds_dict = {}
+        for _plan in self.plans:
+            if _plan['name'] is None:
+                raise LauntelError(
+                    f'{_ISP} plan {_plan["psid"]} name not found.')
+            _speeds_dict[_plan['psid']] = {
+                'name': _plan['name'].replace('\t', '').replace('\n', '').replace('[1]', ''),
+                'spend': _plan['spend'],
+                'ntdupgrade': _plan['ntdupgrade'],
+            }
+        return dict(sorted(_speeds_dict.items(),
+                           key=lambda x: float(x[1]['spend'])))
+
+    def shaper_control(self):
+        """
+        Get shaper control info, as soup_reference.get_shaper_control
+        """
+        _queue_type = None
+        for _q_type in ['shape', 'police']:
+            if 'checked' in self.find_input(
+                    'queue_type', name='queue_type', value=_q_type):
+                _queue_type = _q_type
+                break
+        _controls = {}
+        for _control_name in ['shaperdown_control', 'shaperup_control']:
+            _controls[_control_name] = None
+            for _option in _SHAPER_CONTROLS:
+                if 'checked' in self.find_input(
+                        _control_name, name=_control_name,
+                        id=f'{_control_name}_{_option}'):
+                    _controls[_control_name] = _option
+        _down = self.find_input('shaperdown_speed', id='shaperdown_speed')
+        _up = self.find_input('shaperup_speed', id='shaperup_speed')
+        if 'form-shaping' not in self.forms:
+            raise LauntelError(f'{_ISP} page field form-shaping not found.')
+        return {
+            'queue_type': _queue_type,
+            'shaperdown_cont': _controls['shaperdown_control'],
+            'shaperdown_control': _controls['shaperdown_control'],
+            'shaperdown_speed': _down.get('value'),
+            'shaperup_cont': _controls['shaperup_control'],
+            'shaperup_control': _controls['shaperup_control'],
+            'shaperup_speed': _up.get('value'),
+            'shaperdown_max': _down.get('max'),
+            'shaperdown_min': _down.get('min'),
+            'shaperup_max': _up.get('max'),
+            'shaperup_min': _up.get('min'),
+            'shaper_control_url': self.forms['form-shaping'].get('action'),
+        }
+
+
+def extract_page(page, wanted=()):
+    """
+    Extract a portal page from a response, bytes or str in a single pass
+    """
+    _extractor = PageExtractor(wanted)
+    _decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    try:
+        if isinstance(page, (bytes, str)):
+            _extractor.bytes = len(page)
+            _extractor.feed(page if isinstance(page, str)
+                            else _decoder.decode(page, final=True))
+        else:
+            for _chunk in iter(lambda: page.read(16384), b''):
+                _extractor.bytes += len(_chunk)
+                _extractor.feed(_decoder.decode(_chunk))
+            _extractor.feed(_decoder.decode(b'', final=True))
+        _extractor.close()
+    except ExtractionDone:
+        logging.debug('Page extraction stopped early.')
+    return _extractor
+
+
+class PlanCatalog:
+    """
+    On-disk cache of plan catalogs, keyed by avcid and latest/current mode,
+    with a TTL in seconds. The active PSID and service values are live state
+    and are never cached. Updates are serialised so
+    services can be cached from several threads.
+    """
+
+    def __init__(self, path, ttl=86400):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """
+        Load the cache file, empty if missing or unreadable
+        """
+        try:
+            with open(self.path, encoding='utf-8') as _file:
+                return json.load(_file)
+        except (OSError, ValueError):
+            return {'ids': {}, 'catalogs': {}}
+
+    def _save(self, data):
+        """
+        Atomically replace the cache file
+        """
+        _tmp = f'{self.path}.tmp'
+        with open(_tmp, 'w', encoding='utf-8') as _file:
+            json.dump(data, _file)
+        os.replace(_tmp, self.path)
+
+    @staticmethod
+    def _key(avcid, latest):
+        return f'{avcid}:{"latest" if latest else "current"}'
+
+    def get(self, avcid, latest=False):
+        """
+        Return the cached speeds dict, None on a miss or when stale
+        """
+        _entry = self._load()['catalogs'].get(self._key(avcid, latest))
+        if _entry is None:
+            logging.debug('Plan catalog miss for %s.', self._key(avcid, latest))
+            return None
+        if time.time() - _entry['fetched'] > self.ttl:
+            logging.debug('Plan catalog stale for %s.', self._key(avcid, latest))
+            return None
+        logging.debug('Plan catalog hit for %s.', self._key(avcid, latest))
+        return _entry['speeds']
+
+    def put(self, avcid, latest, speeds_dict):
+        """
+        Cache the speeds dict
+        """
+        with self._lock:
+            _data = self._load()
+            _data['catalogs'][self._key(avcid, latest)] = {
+                'fetched': time.time(),
+                'speeds': speeds_dict}
+            self._save(_data)
+
+    def invalidate(self, avcid=None):
+        """
+        Drop the cached catalogs of avcid, or all of them
+        """
+        with self._lock:
+            _data = self._load()
+            _data['catalogs'] = {
+                _key: _entry for _key, _entry in _data['catalogs'].items()
+                if avcid is not None and not _key.startswith(f'{avcid}:')}
+            self._save(_data)
+        logging.debug('Plan catalog invalidated for %s.', avcid or 'all')
+
+    def get_ids(self):
+        """
+        Return the cached userid, avcid and advanced info URL
+        """
+        _ids = self._load()['ids']
+        return (_ids.get('userid', ''), _ids.get('avcid', ''),
+                _ids.get('advanced_url', ''))
+
+    def put_ids(self, userid, avcid, advanced_url):
+        """
+        Cache the userid, avcid and advanced info URL
+        """
+        with self._lock:
+            _data = self._load()
+            _data['ids'] = {'userid': userid, 'avcid': avcid,
+                            'advanced_url': advanced_url}
+            self._save(_data)
+
+
+class HistoryStore:
+    """
+    SQLite history of observed states and committed changes, written in
+    batches and indexed by avcid and time. The connection is shared by the
+    threads of one process under a lock.
+    """
+    COLUMNS = ('ts', 'avcid', 'kind', 'old_psid', 'psid', 'spend',
+               'shaper_down', 'shaper_up', 'complete', 'status')
+
+    def __init__(self, path, batch_size=50, max_age=3600.0):
+        import sqlite3  # pylint: disable=import-outside-toplevel
+        self.path = path
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self._pending = []
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        with self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS events ('
+                'ts REAL NOT NULL, avcid TEXT NOT NULL, kind TEXT NOT NULL, '
+                'old_psid TEXT, psid TEXT, spend REAL, shaper_down INTEGER, '
+                'shaper_up INTEGER, complete INTEGER, status TEXT)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS events_avcid_ts '
+                               'ON events (avcid, ts)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS events_kind_ts '
+                               'ON events (kind, ts)')
+
+    def record(self, avcid, kind, **values):
+        """
+        Queue an event, kind is 'state' for an observation or 'speed' or
+        'shaper' for a committed change
+        """
+        values.update(ts=time.time(), avcid=avcid, kind=kind)
+        with self._lock:
+            self._pending.append(tuple(values.get(_column)
+                                       for _column in self.COLUMNS))
+            if len(self._pending) >= self.batch_size or \
+                    values['ts'] - self._pending[0][0] >= self.max_age:
+                self.flush()
+
+    def flush(self):
+        """
+        Write the queued events in one transaction
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            with self._conn:
+                self._conn.executemany(
+                    f'INSERT INTO events ({", ".join(self.COLUMNS)}) VALUES '
+                    f'({", ".join("?" * len(self.COLUMNS))})', self._pending)
+            logging.debug('History wrote %s events.', len(self._pending))
+            self._pending = []
+
+    def close(self):
+        """
+        Flush the queued events and close the database
+        """
+        with self._lock:
+            self.flush()
+            self._conn.close()
+
+    def _where(self, since, until, avcid, kinds):
+        """
+        Return the WHERE clause and parameters of a range query
+        """
+        _clauses = ['ts >= ?', 'ts < ?']
+        _params = [since, until]
+        if avcid is not None:
+            _clauses.append('avcid = ?')
+            _params.append(avcid)
+        _clauses.append(f'kind IN ({", ".join("?" * len(kinds))})')
+        _params.extend(kinds)
+        return ' AND '.join(_clauses), _params
+
+    def changes(self, since, until, avcid=None):
+        """
+        Return the committed changes between since and until timestamps
+        """
+        _where, _params = self._where(since, until, avcid, ('speed', 'shaper'))
+        with self._lock:
+            self.flush()
+            _cursor = self._conn.execute(
+                f'SELECT {", ".join(self.COLUMNS)} FROM events WHERE {_where} '
+                f'ORDER BY ts', _params)
+            _changes = [dict(zip(self.COLUMNS, _row)) for _row in _cursor]
+        for _change in _changes:
+            _change['complete'] = bool(_change['complete'])
+        return _changes
+
+    def daily_spend(self, since, until, avcid=None):
+        """
+        Return the highest observed daily spend per local day and avcid
+        between since and until timestamps
+        """
+        _where, _params = self._where(since, until, avcid, ('state', 'speed'))
+        with self._lock:
+            self.flush()
+            _cursor = self._conn.execute(
+                "SELECT date(ts, 'unixepoch', 'localtime') AS day, avcid, "
+                f'MAX(spend), COUNT(*) FROM events WHERE {_where} '
+                'AND spend IS NOT NULL GROUP BY day, avcid ORDER BY day, avcid',
+                _params)
+            return [{'day': _day, 'avcid': _avcid, 'spend': _spend,
+                     'observations': _count}
+                    for _day, _avcid, _spend, _count in _cursor]
+
+
+@dataclass
+class ChangeResult:
+    """
+    Outcome of a speed or shaper change, changed is False when the desired
+    state was already active and nothing was written
+    """
+    complete: bool
+    status: str
+    changed: bool = True
+
+
+@dataclass
+class WaitResult:
+    """
+    Outcome of waiting for a change to take effect
+    """
+    effective: bool
+    seconds: float
+    polls: int
+
+
+def poll(check, timeout, interval=2.0, max_interval=60.0):
+    """
+    Call check with exponential backoff until it returns True or timeout
+    seconds have passed
+    """
+    _started = time.monotonic()
+    _deadline = _started + timeout
+    _polls = 0
+    while True:
+        _remaining = _deadline - time.monotonic()
+        if _remaining <= 0:
+            return WaitResult(False, time.monotonic() - _started, _polls)
+        time.sleep(min(interval, _remaining))
+        _polls += 1
+        if check():
+            return WaitResult(True, time.monotonic() - _started, _polls)
+        interval = min(interval * 2, max_interval)
+
+
+class CircuitBreaker:
+    """
+    Fail fast after threshold consecutive portal failures, a trial request
+    is let through again after reset seconds
+    """
+
+    def __init__(self, threshold=5, reset=60.0):
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.opened = None
+
+    def check(self):
+        """
+        Raise LauntelError while the circuit is open
+        """
+        if self.opened is not None and \
+                time.monotonic() - self.opened < self.reset:
+            raise LauntelError(
+                f'{_ISP} portal failed {self.failures} times in a row, '
+                f'not retrying for {self.reset:.0f}s.')
+
+    def success(self):
+        """
+        Close the circuit
+        """
+        self.failures = 0
+        self.opened = None
+
+    def failure(self):
+        """
+        Count a failure, opening the circuit at the threshold
+        """
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened = time.monotonic()
+
+
+def retryable(err) -> bool:
+    """
+    Return True if a failed request may succeed when retried: timeouts,
+    connection errors, 429 and 5xx responses
+    """
+    _code = getattr(err, 'code', None)
+    return _code is None or _code == 429 or _code >= 500
+
+
+class Transport:
+    """
+    Portal I/O for a browser with a socket timeout on connect and every
+    read, jittered exponential backoff retries of GET requests only, and a
+    circuit breaker
+    """
+
+    def __init__(self, browser, timeout=_TIMEOUT, retries=_RETRIES,
+                 backoff=0.5, breaker=None):
+        self.browser = browser
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+
+    def open(self, request):
+        """
+        Open a URL or mechanize Request with the browser, POSTs such as the
+        service confirmation and shaper changes are never retried
+        """
+        _method = 'GET' if isinstance(request, str) else request.get_method()
+        _url = request if isinstance(request, str) else request.get_full_url()
+        _retries = self.retries if _method == 'GET' else 0
+        for _attempt in range(_retries + 1):
+            self.breaker.check()
+            try:
+                _response = self.browser.open(request, timeout=self.timeout)
+            except OSError as err:
+                if not retryable(err):
+                    self.breaker.success()
+                    raise LauntelError(
+                        f'{_ISP} {_method} {urlparse(_url).path} failed: {err}') from err
+                self.breaker.failure()
+                if _attempt == _retries:
+                    raise LauntelError(
+                        f'{_ISP} {_method} {urlparse(_url).path} failed: {err}') from err
+                import random  # pylint: disable=import-outside-toplevel
+                _delay = random.uniform(0, self.backoff * 2 ** _attempt)
+                logging.warning('%s %s %s failed: %s, retrying in %.2fs.',
+                                _ISP, _method, urlparse(_url).path, err,
+                                _delay)
+                time.sleep(_delay)
+                continue
+            self.breaker.success()
+            return _response
+        return None
+
+
+class AccountLock:
+    """
+    Cross-process lock of a session cache, so only one mlss.py talks to the
+    portal for an account at a time. The processes sharing the session are
+    tracked by pid so only the last one out signs out. A no-op where fcntl
+    is not available.
+    """
+
+    def __init__(self, session_cache):
+        self.path = f'{session_cache}.lock'
+        self.users_path = f'{session_cache}.users'
+        self.waited = False
+        self._file = None
+        try:
+            import fcntl  # pylint: disable=import-outside-toplevel
+            self._fcntl = fcntl
+        except ImportError:
+            logging.debug('fcntl not available, account lock disabled.')
+            self._fcntl = None
+
+    def _update_users(self, add):
+        """
+        Add or remove this process from the live users, return the others
+        """
+        if self._fcntl is None:
+            return []
+        with open(self.users_path, 'a+', encoding='utf-8') as _file:
+            self._fcntl.flock(_file, self._fcntl.LOCK_EX)
+            _file.seek(0)
+            try:
+                _users = [int(_pid) for _pid in _file.read().split()]
+            except ValueError:
+                _users = []
+            _others = [_pid for _pid in _users
+                       if _pid != os.getpid() and pid_alive(_pid)]
+            _file.seek(0)
+            _file.truncate()
+            _file.write(' '.join(str(_pid) for _pid in
+                                 _others + ([os.getpid()] if add else [])))
+        return _others
+
+    def join(self):
+        """
+        Register this process as a user of the session
+        """
+        self._update_users(True)
+
+    def leave(self):
+        """
+        Unregister this process as a user of the session
+        """
+        self._update_users(False)
+
+    def shared(self) -> bool:
+        """
+        Return True if other live processes use the session
+        """
+        _others = self._update_users(True)
+        return len(_others) > 0
+
+    def acquire(self):
+        """
+        Wait for the lock, waited is set if another process held it
+        """
+        if self._fcntl is None:
+            return
+        self._file = open(self.path, 'a', encoding='utf-8')  # pylint: disable=consider-using-with
+        try:
+            self._fcntl.flock(self._file, self._fcntl.LOCK_EX | self._fcntl.LOCK_NB)
+            self.waited = False
+        except BlockingIOError:
+            logging.info('Waiting for another %s session to finish.', _ISP)
+            self._fcntl.flock(self._file, self._fcntl.LOCK_EX)
+            self.waited = True
+
+    def release(self):
+        """
+        Release the lock
+        """
+        if self._file is not None:
+            self._fcntl.flock(self._file, self._fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def pid_alive(pid) -> bool:
+    """
+    Return True if the process pid is running
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class LauntelClient:
+    """
+    Launtel portal client holding a single authenticated browser session
+    """
+
+    def __init__(self, username='', password='', base_url=_BASE_URL,
+                 session_cache='', catalog=None, credentials=None,
+                 tracer=None, timeout=_TIMEOUT, retries=_RETRIES,
+                 history=None, lock=None, pooled=True, cassette=None):
+        self.username = username
+        self.password = password
+        self.base_url = base_url
+        self.session_cache = session_cache
+        self.catalog = catalog
+        self.credentials = credentials
+        self.tracer = tracer if tracer is not None else Tracer()
+        self.history = history
+        self.lock = lock
+        self.cassette = cassette
+        self.logged_in = False
+        self.userid = ''
+        self.avcid = ''
+        self.advanced_url = ''
+        self.started = time.monotonic()
+        self._modify_page = {}
+        self._speeds = {}
+        self._services_page = None
+        self._service_clients = []
+        self._counter = RequestCounter(self.tracer)
+        self._br = get_browser(pooled)
+        self._br.add_handler(self._counter)
+        if self.cassette is not None:
+            self._br.add_handler(self.cassette)
+        self._transport = Transport(self._br, timeout, retries)
+        if self.session_cache != '':
+            self._br.set_cookiejar(load_session(self.session_cache))
+            self.load_service_ids()
+        if self.catalog is not None and self.avcid == '':
+            self.userid, self.avcid, self.advanced_url = \
+                self.catalog.get_ids()
+
+    @property
+    def requests(self):
+        """
+        Number of HTTP requests made by this client and its service clients
+        """
+        return self._counter.requests + sum(
+            _client.requests for _client in self._service_clients)
+
+    def _pool_total(self, name):
+        """
+        Sum a ConnectionPool counter over this client and its service
+        clients, 0 without pooling
+        """
+        _pool = getattr(self._br, 'pool', None)
+        return (getattr(_pool, name) if _pool is not None else 0) + sum(
+            _client._pool_total(name)  # pylint: disable=protected-access
+            for _client in self._service_clients)
+
+    @property
+    def connections(self):
+        """
+        Number of HTTP connections opened by this client and its service
+        clients
+        """
+        return self._pool_total('connections')
+
+    @property
+    def wire_bytes(self):
+        """
+        Response body bytes received before content decoding
+        """
+        return self._pool_total('wire_bytes')
+
+    @property
+    def decoded_bytes(self):
+        """
+        Response body bytes after content decoding
+        """
+        return self._pool_total('bytes')
+
+    def _url(self, path):
+        """
+        Absolute portal URL for path
+        """
+        return f'{self.base_url}{path}'
+
+    def _follow(self, url, text):
+        """
+        Follow a portal link built from url and text, a browser that hasn't
+        loaded a page yet opens the url directly
+        """
+        from mechanize import BrowserStateError  # pylint: disable=import-outside-toplevel
+        from mechanize import Link  # pylint: disable=import-outside-toplevel
+        try:
+            _request = self._br.click_link(Link(
+                base_url=self.base_url,
+                url=url,
+                text=text,
+                tag='a',
+                attrs=[
+                    ('href',
+                     url)]))
+        except BrowserStateError:
+            _request = urljoin(self.base_url, url)
+        _response = self._transport.open(_request)
+        logging.debug('url:%s', self._br.geturl())
+        return _response
+
+    def _follow_text(self, text):
+        """
+        Follow the link labelled text on the current page
+        """
+        _response = self._transport.open(self._br.click_link(text=text))
+        logging.debug('url:%s', self._br.geturl())
+        return _response
+
+    def _extract(self, page, wanted=()):
+        """
+        Extract a page, tracing the parse time
+        """
+        _started = time.perf_counter()
+        _page = extract_page(page, wanted)
+        self.tracer.record(
+            'parse', bytes=_page.bytes,
+            ms=round((time.perf_counter() - _started) * 1000, 3))
+        return _page
+
+    def _cookiejar(self):
+        """
+        Browser cookiejar
+        """
+        return self._br._ua_handlers['_cookies'].cookiejar  # pylint: disable=protected-access
+
+    def session_id(self):
+        """
+        Return the session_id cookie value, None if not set
+        """
+        for cookie in self._cookiejar():
+            if cookie.name == "session_id":
+                return cookie.value
+        return None
+
+    def session_alive(self) -> bool:
+        """
+        Return True if the current session is still authenticated
+        """
+        from mechanize import LinkNotFoundError  # pylint: disable=import-outside-toplevel
+        self._transport.open(self.base_url)
+        logging.debug('url:%s', self._br.geturl())
+        if urlparse(self._br.geturl()).path.startswith('/login'):
+            logging.debug('Cached session has expired.')
+            return False
+        try:
+            self._br.find_link(text='Services')
+        except LinkNotFoundError:
+            logging.debug('Cached session has expired.')
+            return False
+        logging.debug('Cached session is alive.')
+        self.logged_in = True
+        return True
+
+    def resume(self) -> bool:
+        """
+        Return True if the cached session could be reused
+        """
+        if self.session_cache == '':
+            return False
+        return self.session_alive()
+
+    def ensure_session(self, check=False):
+        """
+        Resume the cached session or login, asking credentials for the
+        username and password if they are not set. With check the session
+        is verified with the portal and pages loaded earlier are dropped,
+        for long running clients.
+        """
+        if check is True:
+            self.drop_pages()
+            if self.logged_in and self.session_alive():
+                return
+            self.logged_in = False
+        if self.logged_in or self.resume():
+            return
+        if (self.username == '' or self.password == '') and \
+                self.credentials is not None:
+            with self.tracer.span('credentials'):
+                self.username, self.password = self.credentials()
+        if self.username == '' or self.password == '':
+            raise LauntelError(
+                f'Quiting, {_ISP} username or password not set.')
+        self.login()
+
+    @traced('login')
+    def login(self) -> bool:
+        """
+        Login to Launtel
+        """
+        self._transport.open(self._url('/login'))
+        self._br.select_form(id='login-form')
+        if self.cassette is not None and self.username:
+            # the password is only sent in the login form, which is redacted
+            self.cassette.secrets.add(self.username)
+        self._br.form['username'] = self.username
+        self._br.form['password'] = self.password
+        _login_page = self._extract(self._transport.open(self._br.click()))
+        for _login_status in _login_page.text['alert-content'][:1]:
+            if _login_status == 'Sorry incorrect login details':
+                logging.debug('%s alert content : %s', _ISP, _login_status)
+                raise LauntelError('Login Failure.')
+        logging.debug('Login Successful.')
+        self.logged_in = True
+        if self.session_cache != '':
+            self.save_session()
+        return True
+
+    def load_service_ids(self):
+        """
+        Load the userid, avcid and advanced info URL cached with the session
+        """
+        try:
+            with open(f'{self.session_cache}.ids', encoding='utf-8') as _file:
+                _ids = json.load(_file)
+        except (OSError, ValueError):
+            return
+        self.userid = _ids.get('userid', '')
+        self.avcid = _ids.get('avcid', '')
+        self.advanced_url = _ids.get('advanced_url', '')
+        logging.debug('Service ids loaded, userid:%s avcid:%s',
+                      self.userid, self.avcid)
+
+    def save_service_ids(self):
+        """
+        Cache the userid, avcid and advanced info URL with the session
+        """
+        with open(f'{self.session_cache}.ids', 'w', encoding='utf-8') as _file:
+            json.dump({'userid': self.userid,
+                       'avcid': self.avcid,
+                       'advanced_url': self.advanced_url}, _file)
+
+    def reload_session(self):
+        """
+        Reload the session cookies and service ids saved by another process
+        """
+        self._br.set_cookiejar(load_session(self.session_cache))
+        self.logged_in = False
+        self.drop_pages()
+        self.load_service_ids()
+
+    def drop_pages(self):
+        """
+        Drop the pages loaded earlier, so the active PSID and plans are read
+        from the portal again
+        """
+        self._modify_page = {}
+        self._speeds = {}
+        self._services_page = None
+
+    @contextmanager
+    def locked(self):
+        """
+        Hold the account lock, if any, reusing the session of the process
+        that held it before
+        """
+        if self.lock is None:
+            yield
+            return
+        with self.lock:
+            if self.lock.waited and self.session_cache != '':
+                logging.debug('Reusing the session saved by another process.')
+                self.reload_session()
+            yield
+
+    def save_session(self):
+        """
+        Save the session cookiejar, including the session_id cookie, to a
+        file only readable by the user from the start
+        """
+        _tmp = f'{self.session_cache}.tmp'
+        try:
+            os.remove(_tmp)
+        except FileNotFoundError:
+            pass
+        with os.fdopen(os.open(_tmp, os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                               0o600), 'w', encoding='utf-8') as _file:
+            _file.write('#LWP-Cookies-2.0\n')
+            _file.write(self._cookiejar().as_lwp_str(
+                ignore_discard=True, ignore_expires=True))
+        os.replace(_tmp, self.session_cache)
+        logging.debug('Session cache saved to %s.', self.session_cache)
+
+    @traced('logout')
+    def logout(self, sign_out=True):
+        """
+        Logout of Launtel, or keep the cached session when sign_out is False
+        or other processes share it
+        """
+        if sign_out is True and self.lock is not None and self.lock.shared():
+            logging.debug('Session shared with other processes.')
+            sign_out = False
+        if sign_out is False:
+            if self.session_cache != '':
+                self.save_session()
+            logging.debug('Sign out skipped.')
+            return
+        self._follow(self._url('/logout_user'), 'Sign Out')
+        self.logged_in = False
+        if self.session_cache != '':
+            clear_session(self.session_cache)
+
+    @traced('services')
+    def _get_services_page(self):
+        """
+        Load the Services page once per session
+        """
+        if self._services_page is None:
+            from mechanize import BrowserStateError  # pylint: disable=import-outside-toplevel
+            from mechanize import LinkNotFoundError  # pylint: disable=import-outside-toplevel
+            self.ensure_session()
+            try:
+                self._br.find_link(text='Services')
+            except (LinkNotFoundError, BrowserStateError):
+                self._transport.open(self.base_url)
+            self._services_page = self._extract(self._follow_text('Services'))
+        return self._services_page
+
+    def service_active(self) -> bool:
+        """
+        Return True if the service status is Active
+        """
+        _services_status = self._get_services_page().text['service-dl']
+        return 'Active' in ''.join(_services_status[:1])
+
+    def get_service_ids(self):
+        """
+        Return the userid and avcid of the service, the Services page is
+        loaded unless they and the advanced info URL are known
+        """
+        if self.avcid != '' and self.advanced_url != '':
+            return self.userid, self.avcid
+        # Make sure we are at the correct starting point
+        self._get_services_page()
+        self.advanced_url = self._br.find_link(text='Show Advanced Info').url
+        parsed_url = urlparse(self.advanced_url)
+        self.userid = parse_qs(parsed_url.query)['userid'][0]
+        self.avcid = parse_qs(parsed_url.query)['avcid'][0]
+        if self.session_cache != '':
+            self.save_service_ids()
+        if self.catalog is not None:
+            self.catalog.put_ids(self.userid, self.avcid, self.advanced_url)
+        return self.userid, self.avcid
+
+    def get_services(self):
+        """
+        Return the userid, avcid and advanced info URL of every service on
+        the Services page
+        """
+        _services = []
+        for _text, _url in self._get_services_page().links:
+            if _text != 'Show Advanced Info':
+                continue
+            _query = parse_qs(urlparse(_url).query)
+            _services.append({'userid': _query['userid'][0],
+                              'avcid': _query['avcid'][0],
+                              'advanced_url': _url})
+        return _services
+
+    def service_client(self, userid, avcid, advanced_url):
+        """
+        Return a client for another service of the account, with its own
+        browser sharing this session's cookies so services can be loaded
+        from separate threads
+        """
+        self.ensure_session()
+        _client = LauntelClient(base_url=self.base_url, catalog=self.catalog,
+                                timeout=self._transport.timeout,
+                                retries=self._transport.retries,
+                                pooled=hasattr(self._br, 'pool'),
+                                cassette=self.cassette)
+        _client._br.set_cookiejar(self._cookiejar())  # pylint: disable=protected-access
+        _client.logged_in = self.logged_in
+        _client.userid = userid
+        _client.avcid = avcid
+        _client.advanced_url = advanced_url
+        self._service_clients.append(_client)
+        return _client
+
+    def _get_modify_page(self, latest=False):
+        """
+        Load the modify service page, or the latest pricing page, directly
+        """
+        if latest in self._modify_page:
+            return self._modify_page[latest]
+        self.ensure_session()
+        self.get_service_ids()
+        _modify_service_url = self._url(
+            f'/service?avcid={self.avcid}&userid={self.userid}')
+        if latest is True:
+            _modify_service_url = f'{_modify_service_url}&latest=1'
+        with self.tracer.span('latest' if latest else 'modify'):
+            _page = self._extract(
+                self._follow(_modify_service_url, 'Modify Service'))
+        if 'manage_service' not in _page.forms:
+            raise LauntelError(f'{_ISP} manage_service form not found.')
+        self._modify_page[latest] = _page
+        if self.catalog is not None:
+            self.catalog.put(self.avcid, latest, _page.speeds_dict())
+        if self.history is not None:
+            _psid = next(iter(_page.service_dict().values()))['psid']
+            _plan = _page.speeds_dict().get(_psid)
+            self.history.record(self.avcid, 'state', psid=_psid,
+                                spend=float(_plan['spend']) if _plan else None)
+        return _page
+
+    def _get_catalog(self, latest=False):
+        """
+        Return the cached speeds dict, None if not cached or stale
+        """
+        if self.catalog is None or self.avcid == '' or \
+                latest in self._modify_page:
+            return None
+        return self.catalog.get(self.avcid, latest)
+
+    def refresh_catalog(self, latest=False):
+        """
+        Drop the cached catalog and reload it from the portal
+        """
+        self._modify_page.pop(latest, None)
+        self._speeds.pop(latest, None)
+        if self.catalog is not None and self.avcid != '':
+            self.catalog.invalidate(self.avcid)
+        return self.get_speeds(latest)
+
+    def get_service(self, latest=False) -> Service:
+        """
+        Return the service values from the modify service page, always read
+        from the portal as they hold the active PSID
+        """
+        _service_dict = self._get_modify_page(latest).service_dict()
+        _avcid, _values = next(iter(_service_dict.items()))
+        return Service(avcid=_avcid, **_values)
+
+    def cached_speeds(self, latest=False):
+        """
+        Return the Speeds from the plan catalog cache, None if not cached or
+        stale. Only for viewing, validation and changes use get_speeds.
+        """
+        _speeds_dict = self._get_catalog(latest)
+        return Speeds.parse(_speeds_dict) if _speeds_dict is not None else None
+
+    def get_speeds(self, latest=False) -> Speeds:
+        """
+        Return the Speeds catalog of PSID to Plan sorted by spend, read from
+        the portal and parsed once per page load
+        """
+        if latest in self._speeds:
+            return self._speeds[latest]
+        self._speeds[latest] = Speeds.parse(
+            self._get_modify_page(latest).speeds_dict())
+        return self._speeds[latest]
+
+    def compare_speeds(self):
+        """
+        Return the current and latest pricing Speeds, the two pages are
+        loaded and parsed at the same time on the shared session
+        """
+        from concurrent.futures import ThreadPoolExecutor  # pylint: disable=import-outside-toplevel
+        self.ensure_session()
+        self.get_service_ids()
+        _latest_client = self.service_client(self.userid, self.avcid,
+                                              self.advanced_url)
+        with ThreadPoolExecutor(max_workers=1) as _pool:
+            _latest = _pool.submit(_latest_client.get_speeds, True)
+            _current = self.get_speeds(False)
+            self._speeds[True] = _latest.result()
+        return _current, self._speeds[True]
+
+    def check_psid(self, psid, latest=False, reconcile=False) -> bool:
+        """
+        Return True if psid is valid against the plans and active psid read
+        from the portal. The active psid is valid when reconciling.
+        """
+        return check_psid(psid, self.get_speeds(latest),
+                          self.get_service(latest).psid, latest, reconcile)
+
+    @traced('shaper')
+    def get_shaper(self) -> Shaper:
+        """
+        Return the shaper control settings
+        """
+        self.ensure_session()
+        self.get_service_ids()
+        _shaper_dict = self._extract(
+            self._follow(self.advanced_url, 'Show Advanced Info'),
+            _SHAPER_FIELDS).shaper_control()
+        _shaper = Shaper(**{_field.name: _shaper_dict[_field.name]
+                            for _field in fields(Shaper)})
+        if self.history is not None:
+            self.history.record(
+                self.avcid, 'state',
+                shaper_down=_shaper.shaperdown_speed or None,
+                shaper_up=_shaper.shaperup_speed or None)
+        return _shaper
+
+    def change_speed(self, psid, latest=False, commit=True,
+                     reconcile=False) -> ChangeResult:
+        """
+        Change the service to psid, only load the confirmation page unless
+        commit is True. When reconciling nothing is written if psid is
+        already active.
+        """
+        if not self.check_psid(psid, latest, reconcile):
+            raise InvalidChange('Requested psid is not valid.')
+        _service = self.get_service(latest)
+        if reconcile is True and psid == _service.psid:
+            return ChangeResult(True, f'Already on psid {psid}', False)
+        self.ensure_session()
+        _confirm_service_url = (f'/confirm_service?userid={_service.userid}'
+                                f'&psid={psid}&'
+                                f'unpause={_service.unpause}&'
+                                f'service_id={_service.service_id}&'
+                                f'upgrade_options={_service.upgrade_options}&'
+                                f'discount_code={_service.discount_code}&'
+                                f'avcid={_service.avcid}&'
+                                f'locid={_service.locid}&'
+                                f'coat={_service.coat}&'
+                                f'churn={_service.churn}')
+        logging.debug('confirm_service_url:%s', _confirm_service_url)
+        with self.tracer.span('confirm'):
+            self._follow(_confirm_service_url, 'Looks great - update it!')
+        if commit is False:
+            return ChangeResult(True, 'Not committed')
+        _spend = self.get_speeds(latest)[psid].spend
+        self.drop_pages()
+        if self.catalog is not None:
+            self.catalog.invalidate(self.avcid)
+        with self.tracer.span('commit'):
+            self._br.select_form(name='confirm_service')
+            _confirm_page = self._extract(
+                self._transport.open(self._br.click()))
+        logging.debug('url:%s', self._br.geturl())
+        _confirm_status = ''.join(_confirm_page.text['service-dl'][:1])
+        _result = ChangeResult('Change in progress' in _confirm_status,
+                               _confirm_status)
+        if self.history is not None:
+            self.history.record(self.avcid, 'speed', old_psid=_service.psid,
+                                psid=psid, spend=_spend,
+                                complete=_result.complete,
+                                status=_result.status)
+        return _result
+
+    def wait_for_speed(self, psid, latest=False, timeout=900,
+                       interval=2.0) -> WaitResult:
+        """
+        Poll the modify service page until psid is the active plan
+        """
+        def _active():
+            self._modify_page.pop(latest, None)
+            _c_psid = self._get_modify_page(latest).service_dict()
+            _c_psid = next(iter(_c_psid.values()))['psid']
+            logging.debug('Active psid is %s, waiting for %s.', _c_psid, psid)
+            return _c_psid == psid
+        return poll(_active, timeout, interval)
+
+    def wait_for_shaper(self, up, down, timeout=900,
+                        interval=2.0) -> WaitResult:
+        """
+        Poll the advanced info page until the up and down overrides are
+        active
+        """
+        def _active():
+            _shaper = self.get_shaper()
+            logging.debug('Active shaper is %s/%s, waiting for %s/%s.',
+                          _shaper.shaperdown_speed, _shaper.shaperup_speed,
+                          down, up)
+            return shaper_matches(_shaper, up, down)
+        return poll(_active, timeout, interval)
+
+    def set_shaper(self, up, down, commit=True, shaper=None,
+                   reconcile=False) -> ChangeResult:
+        """
+        Override the shaper with up and down speeds in Mbps, only validate
+        them unless commit is True. Pass shaper to reuse settings already
+        read with get_shaper. When reconciling nothing is written if the
+        overrides are already active.
+        """
+        if shaper is None:
+            shaper = self.get_shaper()
+        check_shaper_speeds(shaper, down, up)
+        if reconcile is True and shaper_matches(shaper, up, down):
+            return ChangeResult(True, f'Already shaping {down}/{up}', False)
+        if commit is False:
+            return ChangeResult(True, 'Not committed')
+        self.ensure_session()
+        _shaper_control_dict = {
+            "queue_type": shaper.queue_type,
+            "shaperdown_cont": _SHAPER_CONTROL_OPTION,
+            "shaperdown_control": _SHAPER_CONTROL_OPTION,
+            "shaperdown_speed": down,
+            "shaperup_cont": _SHAPER_CONTROL_OPTION,
+            "shaperup_control": _SHAPER_CONTROL_OPTION,
+            "shaperup_speed": up
+        }
+        # Encode the data to URL-encoded format
+        _encoded_data = urlencode(_shaper_control_dict)
+        logging.debug('encoded_data:%s', _encoded_data)
+        from mechanize import Request  # pylint: disable=import-outside-toplevel
+        _request = Request(
+            self._url(shaper.shaper_control_url),
+            data=_encoded_data,
+            headers={'Content-Type': 'application/x-www-form-urlencoded'})
+        with self.tracer.span('commit'):
+            _confirm_page = self._extract(self._transport.open(_request))
+        logging.debug('url:%s', self._br.geturl())
+        _result = ChangeResult(False, '')
+        for _status in _confirm_page.text['alert-content']:
+            if 'Shaping settings updated' in _status:
+                _result = ChangeResult(True, _status)
+                break
+        if self.history is not None:
+            self.history.record(self.avcid, 'shaper', shaper_down=down,
+                                shaper_up=up, complete=_result.complete,
+                                status=_result.status)
+        return _result
 
 
 def signal_handler(sig, frame):
     """
-    Capture Ctrl+C and logout if login was successful
+    Capture Ctrl+C and SIGTERM and logout if login was successful, unless
+    --no-logout keeps the session
     """
     logging.debug('Signal captured: sig: %s frame: %s', sig, frame)
-    print('\nYou pressed Ctrl-C, Quiting.')
-    if _LOGIN_SUCCESSFUL:
-        logout()
-    else:
-        sys.exit(0)
+    if sig == signal.SIGINT:
+        print('\nYou pressed Ctrl-C, Quiting.')
+    if _CLIENT is not None and _CLIENT.logged_in:
+        _CLIENT.logout(sign_out=_SIGN_OUT)
+    sys.exit(0)
 
 
 def create_parser():
@@ -90,12 +1795,134 @@ def create_parser():
         action='store_true',
         help='Use latest PSID options'
     )
+    parser.add_argument(
+        '--compare',
+        action='store_true',
+        help='Show the current and latest pricing of every PSID side by '
+             'side, both loaded at once'
+    )
     parser.add_argument(
         '-d',
         '--debug',
         action='store_true',
         help='Debug logging to stderr'
     )
+    parser.add_argument(
+        '-q',
+        '--quiet',
+        action='store_true',
+        help='Skip table rendering, also skipped when stdout is not a TTY'
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        choices=['table', 'json', 'csv'],
+        default='table',
+        help='Write the service, speeds and shaper as JSON lines or CSV '
+             'records to stdout instead of tables (default: table)'
+    )
+    parser.add_argument(
+        '--session-cache',
+        metavar='FILE',
+        help='Persist the portal session cookies to FILE and reuse them'
+    )
+    parser.add_argument(
+        '--no-logout',
+        action='store_true',
+        help='Skip signing out so the cached session can be reused'
+    )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=_TIMEOUT,
+        metavar='SECONDS',
+        help=f'Portal connect and read timeout (default: {_TIMEOUT:.0f})'
+    )
+    parser.add_argument(
+        '--no-keepalive',
+        action='store_true',
+        help='Open a new connection for every request and don\'t request '
+             'compressed pages'
+    )
+    parser.add_argument(
+        '--retries',
+        type=int,
+        default=_RETRIES,
+        help=f'Retries of failed portal page loads, changes are never '
+             f'retried (default: {_RETRIES})'
+    )
+    parser.add_argument(
+        '--stats',
+        action='store_true',
+        help='Print a summary of the requests made to stderr'
+    )
+    parser.add_argument(
+        '-r',
+        '--reconcile',
+        action='store_true',
+        help='Only commit the speed or shaper if it differs from the active '
+             'one'
+    )
+    parser.add_argument(
+        '--trace',
+        metavar='FILE',
+        help='Append phase spans, HTTP requests and parse times to FILE as '
+             'JSON lines'
+    )
+    parser.add_argument(
+        '--profile',
+        metavar='FILE',
+        help='Dump cProfile statistics of the run to FILE'
+    )
+    parser.add_argument(
+        '--record',
+        metavar='FILE',
+        help='Record the portal requests and responses to the FILE cassette, '
+             'without credentials or session cookies'
+    )
+    parser.add_argument(
+        '--replay',
+        metavar='FILE',
+        help='Replay the portal responses from the FILE cassette instead of '
+             'contacting the portal'
+    )
+    parser.add_argument(
+        '-w',
+        '--wait',
+        action='store_true',
+        help='After a commit, wait until the change is active'
+    )
+    parser.add_argument(
+        '--wait-timeout',
+        metavar='SECONDS',
+        default=900,
+        type=int,
+        help='Longest --wait for a change to be active (default: 900)'
+    )
+    parser.add_argument(
+        '--catalog-cache',
+        metavar='FILE',
+        help='Cache the plan catalog in FILE, view-only runs list the '
+             'cached plans without the portal'
+    )
+    parser.add_argument(
+        '--catalog-ttl',
+        metavar='SECONDS',
+        default=86400,
+        type=int,
+        help='Plan catalog cache lifetime (default: 86400)'
+    )
+    parser.add_argument(
+        '--refresh-catalog',
+        action='store_true',
+        help='Invalidate the plan catalog cache before running'
+    )
+    parser.add_argument(
+        '--history',
+        metavar='FILE',
+        help='Record observed states and committed changes in the SQLite '
+             'database FILE'
+    )
 
     # Add subparser for shaper command
     subparsers = parser.add_subparsers(
@@ -115,155 +1942,445 @@ def create_parser():
         help='Shaper download, percentage of plan speed.'
     )
 
+    # Add subparser for daemon command
+    parser_daemon = subparsers.add_parser(
+        'daemon', help='Run scheduled speed and shaper changes on one session')
+    parser_daemon.add_argument(
+        '--schedule',
+        metavar='FILE',
+        required=True,
+        help='JSON schedule of changes, e.g. '
+             '[{"at": "18:00", "psid": "123", "up": 95, "down": 108}]'
+    )
+    parser_daemon.add_argument(
+        '--warmup',
+        metavar='SECONDS',
+        default=60,
+        type=int,
+        help='Check the session and load pages this long before each change'
+    )
+
+    # Add subparser for history command
+    parser_history = subparsers.add_parser(
+        'history', help='Query the --history database')
+    parser_history.add_argument(
+        '--days',
+        default=30,
+        type=int,
+        help='Query the last DAYS days (default: 30)'
+    )
+    parser_history.add_argument(
+        '--since',
+        metavar='YYYY-MM-DD',
+        help='Query from this local date instead of --days'
+    )
+    parser_history.add_argument(
+        '--until',
+        metavar='YYYY-MM-DD',
+        help='Query up to, not including, this local date (default: now)'
+    )
+    parser_history.add_argument(
+        '--avcid',
+        help='Only query this service'
+    )
+    parser_history.add_argument(
+        '--spend',
+        action='store_true',
+        help='Show the daily spend and total instead of the changes'
+    )
+
+    # Add subparser for services command
+    parser_services = subparsers.add_parser(
+        'services', help='Show, and change, every service on the account')
+    parser_services.add_argument(
+        '--targets',
+        metavar='FILE',
+        help='JSON object of avcid to target, e.g. {"AVC000123456789": '
+             '{"psid": "123", "up": 95, "down": 108}}'
+    )
+    parser_services.add_argument(
+        '--workers',
+        default=4,
+        type=int,
+        help='Services loaded at the same time (default: 4)'
+    )
+
+    # Add subparser for fleet command
+    parser_fleet = subparsers.add_parser(
+        'fleet', help='Apply speed and shaper targets to several accounts')
+    parser_fleet.add_argument(
+        '--config',
+        metavar='FILE',
+        required=True,
+        help='JSON list of accounts and targets, e.g. [{"name": "home", '
+             '"username": "me", "password_env": "HOME_PASSWORD", '
+             '"psid": "123", "up": 95, "down": 108}]'
+    )
+    parser_fleet.add_argument(
+        '--workers',
+        default=4,
+        type=int,
+        help='Accounts run at the same time (default: 4)'
+    )
+    parser_fleet.add_argument(
+        '--report',
+        metavar='FILE',
+        help='Write the results of all accounts to FILE as JSON'
+    )
+
+    # Add subparser for exporter command
+    parser_exporter = subparsers.add_parser(
+        'exporter', help='Serve Prometheus metrics of the plan and shaper')
+    parser_exporter.add_argument(
+        '--port',
+        default=9877,
+        type=int,
+        help='Port to serve /metrics on (default: 9877)'
+    )
+    parser_exporter.add_argument(
+        '--address',
+        default='127.0.0.1',
+        help='Address to serve /metrics on (default: 127.0.0.1)'
+    )
+    parser_exporter.add_argument(
+        '--interval',
+        metavar='SECONDS',
+        default=300,
+        type=int,
+        help='Refresh the portal data this often (default: 300)'
+    )
+
+    # Add subparser for serve command
+    parser_serve = subparsers.add_parser(
+        'serve', help='Serve a local JSON API to read and change the plan '
+                      'and shaper')
+    parser_serve.add_argument(
+        '--port',
+        default=9878,
+        type=int,
+        help='Port to serve the API on (default: 9878)'
+    )
+    parser_serve.add_argument(
+        '--address',
+        default='127.0.0.1',
+        help='Address to serve the API on (default: 127.0.0.1)'
+    )
+    parser_serve.add_argument(
+        '--ttl',
+        metavar='SECONDS',
+        default=60,
+        type=int,
+        help='Answer reads from the portal data cached this long '
+             '(default: 60)'
+    )
+
+    # Add subparser for spool command
+    parser_spool = subparsers.add_parser(
+        'spool', help='Apply bursts of change requests from a spool '
+                      'directory once')
+    parser_spool.add_argument(
+        '--dir',
+        metavar='DIR',
+        required=True,
+        help='Spool directory of JSON change requests, e.g. '
+             '{"psid": "123", "up": 95, "down": 108}'
+    )
+    parser_spool.add_argument(
+        '--window',
+        metavar='SECONDS',
+        default=10,
+        type=float,
+        help='Apply the requests once none arrive for this long '
+             '(default: 10)'
+    )
+    parser_spool.add_argument(
+        '--max-wait',
+        metavar='SECONDS',
+        default=60,
+        type=float,
+        help='Apply the requests at most this long after the first '
+             '(default: 60)'
+    )
+    parser_spool.add_argument(
+        '--submit',
+        metavar='JSON',
+        help='Write a change request to the spool directory and exit'
+    )
+
     return parser
 
 
-def get_credentials(prompt):
+def get_credentials(prompt, username='', password=''):
     """
     Generic funtion to prompt for credentials
     """
     if sys.stdin.isatty():
         print(prompt)
-        if _USERNAME == '':
+        if username == '':
             username = input('Username: ')
         else:
-            username = _USERNAME
             print(f'Username: {username}')
-        if _PASSWORD == '':
+        if password == '':
             password = getpass.getpass('Password: ')
-        else:
-            password = _PASSWORD
     else:
-        if _USERNAME == '':
+        if username == '':
             username = sys.stdin.readline().rstrip()
         else:
-            username = _USERNAME
             print(f'Username: {username}')
-        if _PASSWORD == '':
+        if password == '':
             password = sys.stdin.readline().rstrip()
-        else:
-            password = _PASSWORD
     return [username, password]
 
 
-def get_browser():
+def load_credentials():
+    """
+    Return username and password from the config, .env, ENV or a prompt
+    """
+    _username = _USERNAME
+    _password = _PASSWORD
+    from dotenv import load_dotenv  # pylint: disable=import-outside-toplevel
+    # Load variables from .env file
+    load_dotenv()
+    # Check and utilise ENV variables for user credentials
+    if os.getenv("LAUNTEL_USERNAME") is not None:
+        _username = os.getenv("LAUNTEL_USERNAME")
+    if os.getenv("LAUNTEL_PASSWORD") is not None:
+        _password = os.getenv("LAUNTEL_PASSWORD")
+
+    # if ENV not set, interactivly prompt for user credentials
+    if _username == '' or _password == '':
+        logging.debug('%s username or password not set.', _ISP)
+        _username, _password = get_credentials(
+            f'Enter your {_ISP} credentials:', _username, _password)
+    return _username, _password
+
+
+def replay_credentials():
+    """
+    Return the placeholder credentials of a replayed login
+    """
+    return _REDACTED, _REDACTED
+
+
+class ConnectionPool:
+    """
+    Persistent HTTP(S) connections per host with gzip/deflate decoding,
+    counting the connections opened and the bytes on the wire
+    """
+
+    def __init__(self, max_idle=4.0):
+        self.max_idle = max_idle
+        self.connections = 0
+        self.wire_bytes = 0
+        self.bytes = 0
+        self._idle = {}
+
+    def connection(self, key, factory, timeout, fresh=False):
+        """
+        Return an idle connection to key, or a new one from factory
+        """
+        _conn, _used = self._idle.pop(key, (None, 0.0))
+        if _conn is not None and \
+                (fresh or time.monotonic() - _used > self.max_idle):
+            _conn.close()
+            _conn = None
+        if _conn is None:
+            _conn = factory(key[1], timeout=timeout)
+            self.connections += 1
+            return _conn, False
+        if isinstance(timeout, (int, float)):
+            _conn.timeout = timeout
+            if _conn.sock is not None:
+                _conn.sock.settimeout(timeout)
+        return _conn, True
+
+    def release(self, key, conn):
+        """
+        Keep a connection for the next request to key
+        """
+        self._idle[key] = (conn, time.monotonic())
+
+    def decode(self, headers, body):
+        """
+        Return the body without its content encoding, updating headers
+        """
+        import zlib  # pylint: disable=import-outside-toplevel
+        self.wire_bytes += len(body)
+        _encoding = (headers.get('Content-Encoding') or '').lower()
+        if _encoding == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif _encoding == 'deflate':
+            try:
+                body = zlib.decompress(body)
+            except zlib.error:
+                body = zlib.decompress(body, -zlib.MAX_WBITS)
+        if _encoding in ('gzip', 'deflate'):
+            del headers['Content-Encoding']
+            del headers['Content-Length']
+            headers['Content-Length'] = str(len(body))
+        self.bytes += len(body)
+        return body
+
+    def close(self):
+        """
+        Close the idle connections
+        """
+        for _conn, _ in self._idle.values():
+            _conn.close()
+        self._idle = {}
+
+
+@functools.lru_cache(maxsize=None)
+def pooled_browser_class():
+    """
+    Return a mechanize Browser class whose HTTP and HTTPS handlers send
+    requests on pooled keep-alive connections accepting gzip and deflate
     """
-    Create _browser and set desired defaults
+    import http.client  # pylint: disable=import-outside-toplevel
+    import io  # pylint: disable=import-outside-toplevel
+    import socket  # pylint: disable=import-outside-toplevel
+    from mechanize import Browser  # pylint: disable=import-outside-toplevel
+    from mechanize import HTTPHandler  # pylint: disable=import-outside-toplevel
+    from mechanize import HTTPSHandler  # pylint: disable=import-outside-toplevel
+    from mechanize import URLError  # pylint: disable=import-outside-toplevel
+    from mechanize._response import closeable_response  # pylint: disable=import-outside-toplevel
+
+    class PooledMixin:
+        """
+        do_open on the browser's connection pool, a stale reused
+        connection is replaced and GETs resent once
+        """
+
+        def do_open(self, http_class, req):
+            """
+            Send req on a pooled connection, return the decoded response
+            """
+            if req._tunnel_host:  # pylint: disable=protected-access
+                return super().do_open(http_class, req)
+            _pool = self.parent.pool
+            _key = (req.get_type(), req.get_host())
+            _headers = dict(req.headers)
+            _headers.update(req.unredirected_hdrs)
+            _headers = {_name.title(): _value
+                        for _name, _value in _headers.items()}
+            _headers['Connection'] = 'keep-alive'
+            _headers['Accept-Encoding'] = 'gzip, deflate'
+            if self.parent.finalize_request_headers is not None:
+                self.parent.finalize_request_headers(req, _headers)
+            _fresh = False
+            while True:
+                _conn, _reused = _pool.connection(_key, http_class,
+                                                      req.timeout, _fresh)
+                try:
+                    _conn.request(req.get_method(), req.get_selector(),
+                                  req.data, _headers)
+                    _response = _conn.getresponse()
+                    _body = _response.read()
+                    break
+                except (http.client.RemoteDisconnected, BrokenPipeError,
+                        ConnectionResetError) as err:
+                    _conn.close()
+                    if not _reused or req.get_method() != 'GET':
+                        raise URLError(err) from err
+                    logging.debug('Stale connection to %s, reconnecting.',
+                                  _key[1])
+                    _fresh = True
+                except (socket.error, http.client.HTTPException) as err:
+                    _conn.close()
+                    raise URLError(err) from err
+            if _response.will_close:
+                _conn.close()
+            else:
+                _pool.release(_key, _conn)
+            _body = _pool.decode(_response.msg, _body)
+            return closeable_response(
+                io.BytesIO(_body), _response.msg, req.get_full_url(),
+                _response.status, _response.reason,
+                getattr(_response, 'version', None))
+
+    class PooledHTTPHandler(PooledMixin, HTTPHandler):
+        """
+        Pooled HTTP handler
+        """
+
+    class PooledHTTPSHandler(PooledMixin, HTTPSHandler):
+        """
+        Pooled HTTPS handler
+        """
+
+    class PooledBrowser(Browser):
+        """
+        Browser owning a ConnectionPool for its HTTP(S) handlers
+        """
+        handler_classes = dict(Browser.handler_classes,
+                               http=PooledHTTPHandler,
+                               https=PooledHTTPSHandler)
+
+        def __init__(self, *args, **kwargs):
+            self.pool = ConnectionPool()
+            super().__init__(*args, **kwargs)
+
+        def close(self):
+            """
+            Close the browser and its pooled connections
+            """
+            super().close()
+            self.pool.close()
+
+    return PooledBrowser
+
+
+def get_browser(pooled=True):
+    """
+    Create _browser and set desired defaults, sending requests on pooled
+    keep-alive connections unless pooled is False
     """
-    browser = Browser()
+    if pooled is True:
+        browser = pooled_browser_class()()
+    else:
+        from mechanize import Browser  # pylint: disable=import-outside-toplevel
+        browser = Browser()
     browser.set_handle_robots(False)   # ignore robots
     browser.set_handle_refresh(False)  # can sometimes hang without this
     browser.addheaders = [('User-agent', 'Firefox')]
     return browser
 
 
-def logout():
+def load_session(session_cache):
     """
-    Logout of Launtel
+    Load the cached session cookiejar, empty if missing or unreadable
     """
-    if _SHAPER is True:
-        logging.info(
-            '%s shaper change complete status is %s, signing out.',
-            _ISP, _COMPLETE)
-    else:
-        logging.info(
-            '%s speed change complete status is %s, signing out.',
-            _ISP, _COMPLETE)
-    _br.follow_link(Link(
-        base_url=_BASE_URL,
-        url=_SIGNOUT_URL,
-        text='Sign Out',
-        tag='a',
-        attrs=[
-            ('href',
-             _SIGNOUT_URL)]))
-    logging.debug('url:%s', _br.geturl())
-    sys.exit()
-
-
-def login():
-    """
-    Login to Launtel
-    """
-    _br.open(_LOGIN_URL)
-    _br.select_form(id='login-form')
-    _br.form['username'] = _USERNAME
-    _br.form['password'] = _PASSWORD
-    _login_soup = BeautifulSoup(_br.submit().read(), features='lxml')
-    _login_status = _login_soup.find(
-        'div', attrs={
-            'class': 'alert-content'}).text.strip()
-    if _login_status == 'Sorry incorrect login details':
-        logging.error('Login Failure.')
-        logging.debug('%s alert content : %s', _ISP, _login_status)
-        sys.exit()
-    logging.debug('Login Successful.')
-    return True
-
-
-def check_latest(_latest_psid_btn):
+    from mechanize import LWPCookieJar  # pylint: disable=import-outside-toplevel
+    _cookiejar = LWPCookieJar(session_cache)
+    if os.path.exists(session_cache):
+        try:
+            _cookiejar.load(ignore_discard=True, ignore_expires=True)
+            logging.debug('Session cache loaded from %s.', session_cache)
+        except (OSError, ValueError) as err:
+            logging.debug('Session cache not loaded: %s', err)
+    return _cookiejar
+
+
+def clear_session(session_cache):
     """
-    Check latest pricing options exist
+    Remove the session cache once the session has been signed out
     """
-    if _latest_psid_btn is not None:
-        logging.debug('%s available', _latest_psid_btn.text)
-        return True
-    logging.debug('No latest psid options')
-    return False
-
-
-def submit_service_modification():
-    """
-    Prepare the service modification URL and submit modification confirmation if Commit is True
-    """
-    _confirm_service_url = (f'/confirm_service?userid={_USERID}'
-                            f'&psid={_PSID}&'
-                            f'unpause={_UNPAUSE}&'
-                            f'service_id={_SERVICE_ID}&'
-                            f'upgrade_options={_UPGRADE_OPTIONS}&'
-                            f'discount_code={_DISCOUNT_CODE}&'
-                            f'avcid={_AVCID}&'
-                            f'locid={_LOCID}&'
-                            f'coat={_COAT}&'
-                            f'churn={_CHURN}')
-    logging.debug('confirm_service_url:%s', _confirm_service_url)
-    _confirm_service_link = Link(
-        base_url=_BASE_URL,
-        url=_confirm_service_url,
-        text='Looks great - update it!',
-        tag='a',
-        attrs=[
-            ('href',
-             _confirm_service_url)])
-    _br.follow_link(_confirm_service_link)
-    logging.debug('url:%s', _br.geturl())
-    if _COMMIT is True:
-        _br.select_form(name='confirm_service')
-        _confirm_soup = BeautifulSoup(_br.submit().read(), features='lxml')
-        logging.debug('url:%s', _br.geturl())
-        _confirm_status = _confirm_soup.find(
-            'dl', attrs={'class': 'service-dl'}).text.strip()
-        if 'Change in progress' in _confirm_status:
-            logging.info('%s status is "Change in progress".', _ISP)
-        else:
-            logging.error(
-                '%s status is not "Change in progress", please check portal.',
-                _ISP)
-            logout()
+    if os.path.exists(session_cache):
+        os.remove(session_cache)
+        logging.debug('Session cache %s removed.', session_cache)
 
 
-def check_psid():
+def check_psid(psid, speeds, c_psid, latest, reconcile=False):
     """
     Return True if the PSID is valid
     """
     _psid_valid = False
-    for _key in _SPEEDS_DICT:
-        if _PSID == _key:
-            if _PSID == _C_PSID and _LATEST is False:
-                logging.error("Requested psid is not valid.")
-            else:
-                logging.debug('Requested psid is valid.')
-                _psid_valid = True
+    if psid in speeds:
+        if psid == c_psid and latest is False and reconcile is False:
+            logging.error("Requested psid is not valid.")
+        else:
+            logging.debug('Requested psid is valid.')
+            _psid_valid = True
     return _psid_valid
 
 
@@ -276,13 +2393,19 @@ def add_shaper_row(table, label, value, color=None):
     return table
 
 
-def check_shaper(speed, min_key, max_key, percent, name):
+def shaper_matches(shaper, up, down):
+    """
+    Return True if the shaper already overrides with the up and down speeds
+    """
+    return (shaper.shaperdown_speed == str(down) and
+            shaper.shaperup_speed == str(up) and
+            shaper.shaperdown_control == _SHAPER_CONTROL_OPTION and
+            shaper.shaperup_control == _SHAPER_CONTROL_OPTION)
+
+
+def check_shaper(speed, min_speed, max_speed, name):
     """Validate shaper speed and log results."""
-    min_speed = int(_SHAPER_DICT[min_key])
-    max_speed = int(_SHAPER_DICT[max_key])
-    is_valid = min_speed <= speed <= max_speed
-    logging.debug('%s shaper %s %% is %svalid.', name,
-                  percent, '' if is_valid else 'not ')
+    is_valid = int(min_speed) <= speed <= int(max_speed)
     if is_valid:
         logging.debug('%s shaper commit %s is valid.', name, speed)
     else:
@@ -290,88 +2413,52 @@ def check_shaper(speed, min_key, max_key, percent, name):
     return is_valid
 
 
-def get_queue_type(soup):
-    """
-    Get active shaper queue type
-    """
-    queue_types = ['shape', 'police']
-    for q_type in queue_types:
-        attrs = {'name': 'queue_type', 'value': q_type}
-        if soup.find('input', attrs=attrs).get('checked') is not None:
-            return q_type
-    return None
-
-
-def get_shaper_control_option(soup, control_name, options):
+def check_shaper_speeds(shaper, down, up):
     """
-    Get shaper control options
+    Raise LauntelError unless the down and up speeds are within the shaper
+    limits
     """
-    control_option = None
-    for option in options:
-        attrs = {'name': control_name, 'id': f'{control_name}_{option}'}
-        if soup.find('input', attrs=attrs).get('checked') is not None:
-            control_option = option
-    return control_option
+    if not (check_shaper(down, shaper.shaperdown_min,
+                         shaper.shaperdown_max, 'Down') and
+            check_shaper(up, shaper.shaperup_min,
+                         shaper.shaperup_max, 'Up')):
+        raise InvalidChange('Shaper speeds are not valid.')
 
 
-def get_shaper_input_attribute(soup, input_id, attribute):
+def plan_shaper(shaper, plan, target):
     """
-    Get attribute from input element.
+    Return the shaper settings with the min and max speeds scaled from the
+    active plan to the target plan, the portal only shows the limits of the
+    active plan until a speed change is complete
     """
-    return soup.find('input', attrs={'id': input_id}).get(attribute)
-
-
-def get_shaper_control(_br):
+    if plan is None or target.psid == plan.psid or \
+            None in (plan.down, plan.up, target.down, target.up):
+        return shaper
+    return replace(
+        shaper,
+        shaperdown_min=str(round(int(shaper.shaperdown_min) * target.down / plan.down)),
+        shaperdown_max=str(round(int(shaper.shaperdown_max) * target.down / plan.down)),
+        shaperup_min=str(round(int(shaper.shaperup_min) * target.up / plan.up)),
+        shaperup_max=str(round(int(shaper.shaperup_max) * target.up / plan.up)))
+
+
+def get_shaper_speeds(plan, down, up):
     """
-    Get shaper control info
+    Return the shaper down and up speeds as a percentage of the plan speeds
     """
-    soup = BeautifulSoup(_br.follow_link(
-        text='Show Advanced Info'), features='lxml')
-    logging.debug('url:%s', _br.geturl())
-
-    queue_type = get_queue_type(soup)
-    shaperdown_control = get_shaper_control_option(
-        soup, 'shaperdown_control', ['none', 'default', 'override'])
-    shaperup_control = get_shaper_control_option(
-        soup, 'shaperup_control', ['none', 'default', 'override'])
-
-    shaperdown_max = get_shaper_input_attribute(
-        soup, 'shaperdown_speed', 'max')
-    shaperdown_min = get_shaper_input_attribute(
-        soup, 'shaperdown_speed', 'min')
-    shaperdown_speed_value = get_shaper_input_attribute(
-        soup, 'shaperdown_speed', 'value')
-
-    shaperup_max = get_shaper_input_attribute(soup, 'shaperup_speed', 'max')
-    shaperup_min = get_shaper_input_attribute(soup, 'shaperup_speed', 'min')
-    shaperup_speed_value = get_shaper_input_attribute(
-        soup, 'shaperup_speed', 'value')
-
-    shaper_control_url = soup.find(
-        'form', attrs={'name': 'form-shaping'}).get('action')
-
-    shaper_dict = {
-        'queue_type': queue_type,
-        'shaperdown_cont': shaperdown_control,
-        'shaperdown_control': shaperdown_control,
-        'shaperdown_speed': shaperdown_speed_value,
-        'shaperup_cont': shaperup_control,
-        'shaperup_control': shaperup_control,
-        'shaperup_speed': shaperup_speed_value,
-        'shaperdown_max': shaperdown_max,
-        'shaperdown_min': shaperdown_min,
-        'shaperup_max': shaperup_max,
-        'shaperup_min': shaperup_min,
-        'shaper_control_url': shaper_control_url,
-    }
-
-    return shaper_dict
+    if plan.down is None:
+        raise LauntelError(f'{_ISP} plan {plan.psid} speeds not found in "{plan.name}".')
+    logging.debug('Down speed is %s.', plan.down)
+    logging.debug('Up speed is %s.', plan.up)
+    return int(plan.down * (down/100)), int(plan.up * (up/100))
 
 
 def get_shaper_table(_title):
     """
     Create a new shaper table
     """
+    from rich import box  # pylint: disable=import-outside-toplevel
+    from rich.table import Table  # pylint: disable=import-outside-toplevel
     table = Table(
         show_header=True,
         header_style='bold magenta',
@@ -383,7 +2470,7 @@ def get_shaper_table(_title):
     return table
 
 
-def print_shaper_table(_down, _up):
+def print_shaper_table(shaper, _down, _up, commit=False):
     """
     Get the shaper table
     """
@@ -391,34 +2478,34 @@ def print_shaper_table(_down, _up):
     _shaper_table = get_shaper_table(_shaper_title)
     _shaper_table = add_shaper_row(_shaper_table,
                                    'Queue Type',
-                                   _SHAPER_DICT["queue_type"])
+                                   shaper.queue_type)
     _shaper_table = add_shaper_row(_shaper_table,
                                    'Down Control',
-                                   _SHAPER_DICT["shaperdown_control"])
+                                   shaper.shaperdown_control)
     _shaper_table = add_shaper_row(_shaper_table,
                                    'Down Max',
-                                   _SHAPER_DICT["shaperdown_max"])
+                                   shaper.shaperdown_max)
     _shaper_table = add_shaper_row(_shaper_table,
                                    'Down Min',
-                                   _SHAPER_DICT["shaperdown_min"])
+                                   shaper.shaperdown_min)
     _shaper_table = add_shaper_row(_shaper_table,
                                    "Down Value",
-                                   _SHAPER_DICT["shaperdown_speed"],
+                                   shaper.shaperdown_speed,
                                    "bright_green")
     _shaper_table = add_shaper_row(_shaper_table,
                                    'Up Control',
-                                   _SHAPER_DICT["shaperup_control"])
+                                   shaper.shaperup_control)
     _shaper_table = add_shaper_row(_shaper_table,
                                    'Up Max',
-                                   _SHAPER_DICT["shaperup_max"])
+                                   shaper.shaperup_max)
     _shaper_table = add_shaper_row(_shaper_table,
                                    'Up Min',
-                                   _SHAPER_DICT["shaperup_min"])
+                                   shaper.shaperup_min)
     _shaper_table = add_shaper_row(_shaper_table,
                                    "Up Value",
-                                   _SHAPER_DICT["shaperup_speed"],
+                                   shaper.shaperup_speed,
                                    "bright_green")
-    if _COMMIT is True:
+    if commit is True:
         _shaper_table = add_shaper_row(_shaper_table,
                                        "Down Commit",
                                        _down,
@@ -427,6 +2514,7 @@ def print_shaper_table(_down, _up):
                                        "Up Commit",
                                        _up,
                                        "bright_yellow")
+    from rich.console import Console  # pylint: disable=import-outside-toplevel
     _console = Console()
     _console.print(_shaper_table)
 
@@ -437,18 +2525,20 @@ def add_speeds_row(table, label, speed, spend, ntd, color=None):
         label = f'[{color}]{label}[/{color}]'
         speed = f'[{color}]{speed}[/{color}]'
         spend = f'[{color}]{spend}[/{color}]'
-        ntd = f'[{color}]{ntd}[/{color}]'
-    if _NTD:
+        ntd = f'[{color}]{ntd}[/{color}]' if ntd is not None else None
+    if ntd is not None:
         table.add_row(*(label, speed, spend, ntd))
     else:
         table.add_row(*(label, speed, spend))
     return table
 
 
-def get_speeds_table(_title):
+def get_speeds_table(_title, ntd=False):
     """
     Create a new speeds table
     """
+    from rich import box  # pylint: disable=import-outside-toplevel
+    from rich.table import Table  # pylint: disable=import-outside-toplevel
     table = Table(
         show_header=True,
         header_style='bold magenta',
@@ -458,348 +2548,1531 @@ def get_speeds_table(_title):
     table.add_column('PSID')
     table.add_column('SPEED')
     table.add_column('SPEND')
-    if _NTD:
+    if ntd:
         table.add_column('NTDUPGRADE')
     return table
 
 
-def print_speeds_table():
+def compare_records(current, latest):
+    """
+    Return a record per PSID with the current and latest spend and the
+    delta, in current spend order
+    """
+    _records = []
+    for _psid in list(current) + [_psid for _psid in latest
+                                  if _psid not in current]:
+        _plan = current.get(_psid) or latest[_psid]
+        _current = current[_psid].spend if _psid in current else None
+        _latest = latest[_psid].spend if _psid in latest else None
+        _records.append({
+            'psid': _psid, 'name': _plan.name, 'current': _current,
+            'latest': _latest,
+            'delta': round(_latest - _current, 2)
+            if None not in (_current, _latest) else None})
+    return _records
+
+
+def print_compare_table(records, c_psid):
+    """
+    Print the current and latest spend of each PSID and the delta
+    """
+    from rich import box  # pylint: disable=import-outside-toplevel
+    from rich.console import Console  # pylint: disable=import-outside-toplevel
+    from rich.table import Table  # pylint: disable=import-outside-toplevel
+    _table = Table(show_header=True, header_style='bold magenta',
+                   title=f'{_ISP} Current and Latest Speeds', box=box.SQUARE,
+                   show_lines=True)
+    for _column in ('PSID', 'SPEED', 'CURRENT', 'LATEST', 'DELTA'):
+        _table.add_column(_column)
+    for _record in records:
+        _row = [_record['psid'], _record['name']] + [
+            '' if _record[_key] is None else f'{_record[_key]:.2f}'
+            for _key in ('current', 'latest')]
+        if _record['delta'] is None:
+            _row.append('')
+        elif _record['delta'] > 0:
+            _row.append(f'[bright_red]+{_record["delta"]:.2f}[/bright_red]')
+        elif _record['delta'] < 0:
+            _row.append(f'[bright_green]{_record["delta"]:.2f}[/bright_green]')
+        else:
+            _row.append('0.00')
+        if _record['psid'] == c_psid:
+            _row[:4] = [f'[bright_green]{_value}[/bright_green]'
+                        for _value in _row[:4]]
+        _table.add_row(*_row)
+    Console().print(_table)
+
+
+def run_compare(client, args):
+    """
+    Show the current and latest pricing of every PSID side by side
+    """
+    _current, _latest = client.compare_speeds()
+    _records = compare_records(_current, _latest)
+    if args.output != 'table':
+        write_records([dict({'type': 'compare'}, **_record)
+                       for _record in _records], args.output)
+    elif args.quiet is False:
+        print_compare_table(_records, client.get_service().psid)
+    return True
+
+
+def print_speeds_table(speeds, c_psid, latest=False):
     """
     Get the speeds table
     """
-    if _LATEST is True:
+    if latest is True:
         _speeds_title = f'Latest {_ISP} Speeds'
     else:
         _speeds_title = f'{_ISP} Speeds'
-    _speeds_table = get_speeds_table(_speeds_title)
-    for _key, _values in _SPEEDS_DICT.items():
-        _speed_psid = _key
-        _speed_name = _values['name']
-        _speed_daily_spend = _values['spend']
-        if _values['ntdupgrade'] == '':
-            _ntdupgrade = _values['ntdupgrade']
+    _ntd = any(_plan.ntdupgrade is not None for _plan in speeds.values())
+    _speeds_table = get_speeds_table(_speeds_title, _ntd)
+    for _key, _plan in speeds.items():
+        if not _ntd:
+            _ntdupgrade = None
+        elif _plan.ntdupgrade is None:
+            _ntdupgrade = ''
         else:
-            _ntdupgrade = bool(int(_values['ntdupgrade']))
-            _NTD = True  # pylint: disable=invalid-name
+            _ntdupgrade = str(_plan.ntdupgrade)
         _speed_colour = None
-        if _key == _C_PSID and _LATEST is False:
+        if _key == c_psid and latest is False:
             _speed_colour = 'bright_green'
-        elif _key == _C_PSID:
+        elif _key == c_psid:
             _speed_colour = 'bright_yellow'
         _speeds_table = add_speeds_row(
             _speeds_table,
-            _speed_psid,
-            _speed_name,
-            _speed_daily_spend,
-            str(_ntdupgrade),
+            _key,
+            _plan.name,
+            f'{_plan.spend:.2f}',
+            _ntdupgrade,
             _speed_colour)
 
+    from rich.console import Console  # pylint: disable=import-outside-toplevel
     _console = Console()
     _console.print(_speeds_table)
 
 
-def get_speeds_dict(soup):
+def wait_for_change(change, args, wait, *wait_args):
     """
-    Get a dict of speeds sorted by spend
+    Wait for a committed change to be active, return True if it is
     """
-    _speeds = soup.find_all(
-        'span', attrs={'data-value': True})
-    _speeds_dict = {}
+    _result = wait(*wait_args, timeout=args.wait_timeout)
+    if _result.effective:
+        logging.info('%s %s change effective after %.1fs and %s polls.',
+                     _ISP, change, _result.seconds, _result.polls)
+    else:
+        logging.error('%s %s change not effective after %.1fs and %s polls, '
+                      'please check portal.', _ISP, change, _result.seconds,
+                      _result.polls)
+    return _result.effective
 
-    for speed in _speeds:
-        _speed_name = speed.find(
-            'div', attrs={
-                'class': 'col-sm-4'}).text.strip()
-        _speed_psid = speed.get('data-value')
-        _speed_daily_spend = speed.get('data-plancharge')
-        _speed_ntdupgrade = speed.get('data-ntdupgrade')
-        _speeds_dict[_speed_psid] = {
-            'name': _speed_name.replace('\t', '').replace('\n', '').replace('[1]', ''),
-            'spend': _speed_daily_spend,
-            'ntdupgrade': _speed_ntdupgrade,
-        }
-    # Sort the dictionary by spend value
-    _sorted_speeds_dict = dict(
-        sorted(_speeds_dict.items(), key=lambda x: x[1]['spend'])
-    )
-
-    return _sorted_speeds_dict
-
-
-def get_service_dict(soup):
-    """
-    Get a dict of the service
-    """
-    # Find all the values utilised within Launtels service modification
-    # and necessary for next services of validations and script steps
-    _userid = soup.find(
-        'input', attrs={'name': 'userid'}).get('value')
-    _c_psid = soup.find(
-        'input', attrs={'name': 'psid'}).get('value')
-    _unpause = soup.find(
-        'input', attrs={'name': 'unpause'}).get('value')
-    _service_id = soup.find(
-        'input', attrs={
-            'name': 'service_id'}).get('value')
-    _upgrade_options = soup.find(
-        'span', attrs={'class': 'rollover list-group-item'}).get('value')
-    _discount_code = ''  # /check_discount/0/{_AVCID}/
-    _avcid = soup.find(
-        'input', attrs={'name': 'avcid'}).get('value')
-    _locid = soup.find(
-        'input', attrs={'name': 'locid'}).get('value')
-    _coat = soup.find('input', attrs={'name': 'coat'}).get('value')
-    _churn = soup.find('input', attrs={'name': 'coat'}).get('value')
-
-    _service_dict = {}
-    _service_dict[_avcid] = {
-        'userid': _userid,
-        'psid': _c_psid,
-        'unpause': _unpause,
-        'service_id': _service_id,
-        'upgrade_options': _upgrade_options,
-        'discount_code': _discount_code,
-        'locid': _locid,
-        'coat': _coat,
-        'churn': _churn}
-
-    return _service_dict
-
-
-def print_active_service_status():
-    """
-    Check active service status
-    """
-    _services_soup = BeautifulSoup(
-        _br.follow_link(
-            text='Services').read(),
-        features='lxml')
-    logging.debug('url:%s', _br.geturl())
-    _services_status = _services_soup.find(
-        'dl', attrs={'class': 'service-dl'}).text.strip()
-
-    if 'Active' in _services_status:
-        logging.debug('%s service status is Active.', _ISP)
+
+def show_tables(args):
+    """
+    Return True if tables should be rendered
+    """
+    return args.output == 'table' and args.quiet is False and \
+        sys.stdout.isatty()
+
+
+def write_records(records, output):
+    """
+    Write records, dicts with a 'type', to stdout as JSON lines or as CSV
+    with a header row whenever the columns change
+    """
+    if output == 'json':
+        for _record in records:
+            sys.stdout.write(json.dumps(_record) + '\n')
+        return
+    import csv  # pylint: disable=import-outside-toplevel
+    _writer = csv.writer(sys.stdout, lineterminator='\n')
+    _columns = None
+    for _record in records:
+        if list(_record) != _columns:
+            _columns = list(_record)
+            _writer.writerow(_columns)
+        _writer.writerow(_record.values())
+
+
+def speeds_records(service, speeds, latest=False):
+    """
+    Return the service and speeds catalog as output records
+    """
+    _records = [dict({'type': 'service'}, **asdict(service))]
+    for _plan in speeds.values():
+        _records.append(dict({'type': 'plan'}, **asdict(_plan),
+                             current=_plan.psid == service.psid,
+                             latest=latest))
+    return _records
+
+
+def shaper_records(shaper, down, up, commit=False):
+    """
+    Return the shaper settings, and the speeds to commit, as output records
+    """
+    _record = dict({'type': 'shaper'}, **asdict(shaper))
+    _record.update(down_commit=down if commit else None,
+                   up_commit=up if commit else None)
+    return [_record]
+
+
+def finish(client, args, results):
+    """
+    Log the complete status of each change, e.g. {'speed': True}, together
+    and logout of Launtel
+    """
+    logging.info('%s %s, signing out.', _ISP, ', '.join(
+        f'{_change} change complete status is {_complete}'
+        for _change, _complete in results.items()))
+    if client.logged_in:
+        try:
+            client.logout(sign_out=not args.no_logout)
+        except LauntelError as err:
+            logging.error('Sign out failed: %s', err)
+    if args.stats is True:
+        logging.info('%s requests made: %s in %.2fs.', _ISP, client.requests,
+                     time.monotonic() - client.started)
+        if client.connections:
+            logging.info('%s connections opened: %s, bytes received: %s '
+                         '(%s decoded).', _ISP, client.connections,
+                         client.wire_bytes, client.decoded_bytes)
+
+
+def target_shaper(client, args, c_psid, speeds, psid=None):
+    """
+    Return the shaper down and up speeds and the shaper settings, raise
+    LauntelError if the speeds are not valid. The shaper speeds and limits
+    follow the psid plan when the speed is changed in the same run.
+    """
+    _plan = speeds[psid or c_psid]
+    _shaperdown_speed, _shaperup_speed = get_shaper_speeds(
+        _plan, args.down, args.up)
+    _shaper = plan_shaper(client.get_shaper(), speeds.get(c_psid), _plan)
+    check_shaper_speeds(_shaper, _shaperdown_speed, _shaperup_speed)
+    return _shaperdown_speed, _shaperup_speed, _shaper
+
+
+def run_shaper(client, args, c_psid, speeds, psid=None, target=None):
+    """
+    View or commit a shaper change, return the complete status. Pass target
+    to reuse the speeds and settings already validated with target_shaper.
+    """
+    _shaperdown_speed, _shaperup_speed, _shaper = \
+        target or target_shaper(client, args, c_psid, speeds, psid)
+
+    if args.output != 'table':
+        write_records(shaper_records(_shaper, _shaperdown_speed,
+                                     _shaperup_speed, args.commit),
+                      args.output)
+    elif show_tables(args):
+        print_shaper_table(_shaper, _shaperdown_speed, _shaperup_speed,
+                           args.commit)
+    _result = client.set_shaper(_shaperup_speed, _shaperdown_speed,
+                                args.commit, _shaper, args.reconcile)
+    if _result.changed is False:
+        logging.info('%s shaper is already %s/%s, nothing to commit.', _ISP,
+                     _shaperdown_speed, _shaperup_speed)
+        return True
+    if args.commit is False:
+        return True
+    if _result.complete:
+        logging.info('%s status is "Shaping settings updated - may take a minute to take effect".', _ISP)
     else:
-        logging.debug('%s service status is not Active.', _ISP)
-
-
-def print_cookies():
-    """
-    Print _browser session_id cookie
-    """
-    _cookies = _br._ua_handlers['_cookies'].cookiejar  # pylint: disable=protected-access
-    for cookie in _cookies:
-        if cookie.name == "session_id":
-            _session_id = cookie.value
-            logging.debug('%s=%s', cookie.name, _session_id)
-
-
-signal.signal(signal.SIGINT, signal_handler)
-# parse the arguments
-_parser = create_parser()
-args = _parser.parse_args()
-
-if args.debug is True:
-    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
-    logger = logging.getLogger(__name__)
-    logging.debug('Debug is True.')
-else:
-    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
-    logger = logging.getLogger(__name__)
-
-# get the arguments value for psid
-if args.psid is not None:
-    _PSID = args.psid
-
-# get the arguments value for commit
-if args.commit is True:
-    logging.debug('Commit is True.')
-    _COMMIT = True
-else:
-    logging.debug('Commit is False.')
-
-# get the arguments value for commit
-if args.latest is True:
-    logging.debug('Use latest psid options is True.')
-    _LATEST = True
-else:
-    logging.debug('Use latest psid options is False.')
-
-# get the arguments value for commit
-if args.command == 'shaper':
-    logging.debug('Shaper control is True.')
-    _SHAPER = True
-    _UP = int(args.up)
-    _DOWN = int(args.down)
-else:
-    logging.debug('Shaper control is False.')
-
-
-# Load variables from .env file
-load_dotenv()
-# Check and utilise ENV variables for user credentials
-if os.getenv("LAUNTEL_USERNAME") is not None:
-    _USERNAME = os.getenv("LAUNTEL_USERNAME")
-if os.getenv("LAUNTEL_PASSWORD") is not None:
-    _PASSWORD = os.getenv("LAUNTEL_PASSWORD")
-
-# if ENV not set, interactivly prompt for user credentials
-if _USERNAME == '' or _PASSWORD == '':
-    logging.debug('%s username or password not set.', _ISP)
-    _isp_credentials = get_credentials(f'Enter your {_ISP} credentials:')
-    _USERNAME = _isp_credentials[0]
-    _PASSWORD = _isp_credentials[1]
-
-if _USERNAME == '' or _PASSWORD == '':
-    logging.error('Quiting, %s username or password not set.', _ISP)
-    sys.exit()
-
-_br = get_browser()
-_LOGIN_SUCCESSFUL = login()
-if args.debug is True:
-    print_cookies()
-    print_active_service_status()
-# Make sure we are at the correct starting point
-_br.follow_link(text='Services')
-logging.debug('url:%s', _br.geturl())
-parsed_url = urlparse(_br.find_link(text='Show Advanced Info').url)
-_USERID = parse_qs(parsed_url.query)['userid'][0]
-_AVCID = parse_qs(parsed_url.query)['avcid'][0]
-_MODIFY_SERVICE_URL = f'{_MODIFY_SERVICE_URL}?avcid={_AVCID}&userid={_USERID}'
-_soup = BeautifulSoup(
-    _br.follow_link(Link(
-        base_url=_BASE_URL,
-        url=_MODIFY_SERVICE_URL,
-        text='Modify Service',
-        tag='a',
-        attrs=[
-            ('href',
-             _MODIFY_SERVICE_URL)])).read(),
-    features='lxml')
-logging.debug('url:%s', _br.geturl())
-_br.select_form(name='manage_service')
-
-# Check if new pricing or plan options exist
-if _LATEST is True and check_latest(
-    _soup.find(
-        "button", {
-            "onclick": "showLatest()"})) is True:
-    _LATEST_PSID_URL = f'{_MODIFY_SERVICE_URL}&latest=1'
-    _soup = BeautifulSoup(
-        _br.follow_link(Link(
-            base_url=_BASE_URL,
-            url=_LATEST_PSID_URL,
-            text='Show Latest Pricing Options',
-            tag='a',
-            attrs=[
-                ('href',
-                 _LATEST_PSID_URL)])).read(),
-        features='lxml')
-    logging.debug('url:%s', _br.geturl())
-    _br.select_form(name='manage_service')
-
-# Get a dict with all the service information
-_SERVICE_DICT = get_service_dict(_soup)
-# Set the remaining required variables
-_C_PSID = _SERVICE_DICT[_AVCID]['psid']
-_UNPAUSE = _SERVICE_DICT[_AVCID]['unpause']
-_SERVICE_ID = _SERVICE_DICT[_AVCID]['service_id']
-_UPGRADE_OPTIONS = _SERVICE_DICT[_AVCID]['upgrade_options']
-_DISCOUNT_CODE = _SERVICE_DICT[_AVCID]['discount_code']
-_LOCID = _SERVICE_DICT[_AVCID]['locid']
-_COAT = _SERVICE_DICT[_AVCID]['coat']
-_CHURN = _SERVICE_DICT[_AVCID]['coat']
-# Get speeds and print
-_SPEEDS_DICT = get_speeds_dict(_soup)
-
-if _SHAPER is True:
-    _br.follow_link(text='Services')
-    _SHAPERUP_SPEED = ''
-    _SHAPERDOWN_SPEED = ''
-    for _key, values in _SPEEDS_DICT.items():
-        if _key == _C_PSID:
-            _speed_name = values['name']
-            pattern = re.escape('(') + "(.*?)" + re.escape(')')
-            _speed_plan = re.findall(pattern, _speed_name)
-            _speed_plan = _speed_plan[0].split('/')
-            _SHAPERDOWN_SPEED = int(int(_speed_plan[0]) * (_DOWN/100))
-            _SHAPERUP_SPEED = int(int(_speed_plan[1]) * (_UP/100))
-            logging.debug('Down speed is %s.', _speed_plan[0])
-            logging.debug('Up speed is %s.', _speed_plan[1])
-    _SHAPER_DICT = get_shaper_control(_br)
-
-    _SHAPERDOWN_VALID = check_shaper(
-        _SHAPERDOWN_SPEED, "shaperdown_min", "shaperdown_max", _DOWN, "Down"
-    )
-    _SHAPERUP_VALID = check_shaper(
-        _SHAPERUP_SPEED, "shaperup_min", "shaperup_max", _UP, "Up"
-    )
-
-    if not (_SHAPERDOWN_VALID and _SHAPERUP_VALID):
-        _COMPLETE = False
-        logout()
-
-    print_shaper_table(_SHAPERDOWN_SPEED, _SHAPERUP_SPEED)
-
-    _SHAPER_CONTROL_URL = _BASE_URL + _SHAPER_DICT["shaper_control_url"]
-    if _COMMIT is True:
-        # Define _SHAPER_CONTROL_DATA as a dictionary directly
-        _SHAPER_CONTROL_DICT = {
-            "queue_type": _SHAPER_DICT["queue_type"],
-            "shaperdown_cont": _SHAPER_CONTROL_OPTION,
-            "shaperdown_control": _SHAPER_CONTROL_OPTION,
-            "shaperdown_speed": _SHAPERDOWN_SPEED,
-            "shaperup_cont": _SHAPER_CONTROL_OPTION,
-            "shaperup_control": _SHAPER_CONTROL_OPTION,
-            "shaperup_speed": _SHAPERUP_SPEED
-        }
-        # Encode the data to URL-encoded format
-        _ENCODED_DATA = urlencode(_SHAPER_CONTROL_DICT)
-        # Debug: Print the encoded data to verify
-        logging.debug('encoded_data:%s',_ENCODED_DATA)
-        # Set Content-Type header for x-www-form-urlencoded
-        _br.addheaders = [('Content-Type', 'application/x-www-form-urlencoded')]
-        # Encode the data to URL-encoded format and Post
-        _confirm_soup = BeautifulSoup(_br.open(_SHAPER_CONTROL_URL, data=_ENCODED_DATA).read(), features='lxml')
-        logging.debug('url:%s', _br.geturl())
-        _confirm_status = _confirm_soup.findAll(
-            'div', attrs={'class': 'alert-content'})
-        for status in _confirm_status:
-            _CS = str(status.encode('utf-8'))
-            if 'Shaping settings updated' in _CS:
-                logging.info('%s status is "Shaping settings updated - may take a minute to take effect".', _ISP)
-                _COMPLETE = True
-                logout()
-        if not _COMPLETE:
+        logging.error(
+            '%s status is not "Shaping settings updated - may take a minute to take effect", please check portal.',
+            _ISP)
+        return False
+    if args.wait is True:
+        return wait_for_change('shaper', args, client.wait_for_shaper,
+                               _shaperup_speed, _shaperdown_speed)
+    return True
+
+
+def check_target(target):
+    """
+    Return why a target like {"psid": "123", "latest": false, "up": 95,
+    "down": 108} is not valid, None if it is
+    """
+    if not isinstance(target, dict):
+        return 'must be an object'
+    if 'psid' not in target and ('up' not in target or 'down' not in target):
+        return 'needs psid or up and down'
+    if 'psid' in target and (isinstance(target['psid'], bool) or
+                             not isinstance(target['psid'], (str, int))):
+        return 'psid must be a string or number'
+    for _key in ('up', 'down'):
+        if _key in target and (isinstance(target[_key], bool) or
+                               not isinstance(target[_key], int)):
+            return f'{_key} must be a whole percentage'
+    if not isinstance(target.get('latest', False), bool):
+        return 'latest must be true or false'
+    return None
+
+
+def load_schedule(path):
+    """
+    Load and validate a daemon schedule file, a JSON list of entries like
+    {"at": "18:00", "psid": "123", "latest": false, "up": 95, "down": 108,
+     "days": ["mon", "fri"]}
+    """
+    try:
+        with open(path, encoding='utf-8') as _file:
+            _schedule = json.load(_file)
+    except (OSError, ValueError) as err:
+        raise LauntelError(f'Schedule {path} not loaded: {err}') from err
+    if not isinstance(_schedule, list) or not _schedule:
+        raise LauntelError(f'Schedule {path} must be a list of entries.')
+    for _entry in _schedule:
+        _error = check_target(_entry)
+        if _error is not None:
+            raise LauntelError(f'Schedule entry {_entry} {_error}.')
+        try:
+            datetime.datetime.strptime(_entry['at'], '%H:%M')
+        except (KeyError, TypeError, ValueError) as err:
+            raise LauntelError(f'Schedule entry {_entry} needs "at": "HH:MM".') from err
+        _days = _entry.get('days', _WEEKDAYS)
+        if not isinstance(_days, list) or not _days or \
+                not set(_days) <= set(_WEEKDAYS):
+            raise LauntelError(f'Schedule entry {_entry} days must be some of {_WEEKDAYS}.')
+    return _schedule
+
+
+def next_schedule_entry(schedule, now):
+    """
+    Return the next due schedule entry and its datetime
+    """
+    _next = None
+    for _entry in schedule:
+        _at = datetime.datetime.strptime(_entry['at'], '%H:%M').time()
+        for _day in range(8):
+            _due = datetime.datetime.combine(
+                now.date() + datetime.timedelta(days=_day), _at)
+            if _due > now and \
+                    _WEEKDAYS[_due.weekday()] in _entry.get('days', _WEEKDAYS):
+                if _next is None or _due < _next[1]:
+                    _next = (_entry, _due)
+                break
+    return _next
+
+
+def sleep_until(due):
+    """
+    Sleep until the due datetime, in short steps to follow clock changes
+    """
+    while True:
+        _remaining = (due - datetime.datetime.now()).total_seconds()
+        if _remaining <= 0:
+            return
+        time.sleep(min(_remaining, 60))
+
+
+def run_schedule_entry(client, entry, shaper=None, reconcile=False,
+                       commit=True):
+    """
+    Apply a schedule entry, return the list of change results. The shaper
+    is validated against the limits of the target plan before the speed is
+    changed, a preloaded shaper is only used when the plan doesn't change.
+    When reconciling the active state is read again and only the changes
+    that differ from it are written, without commit the changes
+    are only validated.
+    """
+    _latest = entry.get('latest', False)
+    _results = []
+    if reconcile is True:
+        # Diff against the portal now, not against pages preloaded earlier
+        client.drop_pages()
+        shaper = None
+    _psid = entry.get('psid')
+    if _psid is not None:
+        _psid = str(_psid)
+    _shaper_speeds = None
+    if 'up' in entry and 'down' in entry:
+        # Validate the shaper against the target plan before any change
+        _speeds = client.get_speeds(_latest)
+        _c_plan = _speeds.get(client.get_service(_latest).psid)
+        _plan = _speeds.get(_psid) or _c_plan
+        if _plan is None:
+            raise LauntelError(f'{_ISP} active plan not found, set a psid.')
+        _down, _up = get_shaper_speeds(_plan, entry['down'], entry['up'])
+        if _plan is not _c_plan or shaper is None:
+            shaper = plan_shaper(client.get_shaper(), _c_plan, _plan)
+        check_shaper_speeds(shaper, _down, _up)
+        _shaper_speeds = (_up, _down)
+    if _psid is not None:
+        if client.check_psid(_psid, _latest, reconcile):
+            _results.append(client.change_speed(_psid, _latest, commit,
+                                                reconcile))
+        else:
+            raise InvalidChange(f'Requested psid {_psid} is not valid.')
+    if _shaper_speeds is not None:
+        _results.append(client.set_shaper(*_shaper_speeds, commit, shaper,
+                                          reconcile))
+    return _results
+
+
+def load_fleet(path):
+    """
+    Load and validate a fleet file, a JSON list of accounts like
+    {"name": "home", "username": "me@example.com", "password_env":
+     "HOME_PASSWORD", "psid": "123", "latest": false, "up": 95, "down": 108,
+     "session_cache": "~/.mlss_home"}
+    """
+    try:
+        with open(path, encoding='utf-8') as _file:
+            _fleet = json.load(_file)
+    except (OSError, ValueError) as err:
+        raise LauntelError(f'Fleet {path} not loaded: {err}') from err
+    if not isinstance(_fleet, list) or not _fleet:
+        raise LauntelError(f'Fleet {path} must be a list of accounts.')
+    for _account in _fleet:
+        if not isinstance(_account, dict) or \
+                not isinstance(_account.get('username'), str):
+            raise LauntelError(f'Fleet account {_account} needs "username".')
+        _error = check_target(_account)
+        if _error is not None:
+            raise LauntelError(f'Fleet account {_account["username"]} {_error}.')
+    return _fleet
+
+
+def run_fleet_account(account, args):
+    """
+    Apply a fleet account's targets with its own client, return its report
+    record
+    """
+    _started = time.monotonic()
+    _password = account.get('password', '')
+    if 'password_env' in account:
+        _password = os.getenv(account['password_env'], '')
+    _session_cache = os.path.expanduser(account.get('session_cache', ''))
+    _lock = None
+    if _session_cache != '':
+        _lock = AccountLock(_session_cache)
+        _lock.join()
+    _client = LauntelClient(account['username'], _password,
+                            session_cache=_session_cache,
+                            timeout=args.timeout, retries=args.retries,
+                            lock=_lock, pooled=not args.no_keepalive)
+    _record = {'name': account.get('name', account['username']),
+               'avcid': '', 'psid': '', 'complete': False, 'status': ''}
+    try:
+        with _client.locked():
+            try:
+                _results = run_schedule_entry(_client, account,
+                                              reconcile=args.reconcile,
+                                              commit=args.commit)
+                _record['psid'] = _client.get_service(
+                    account.get('latest', False)).psid
+                _record['complete'] = all(_result.complete
+                                          for _result in _results)
+                _record['status'] = '; '.join(_result.status
+                                              for _result in _results)
+            except (LauntelError, OSError) as err:
+                _record['status'] = str(err)
+            except Exception as err:  # pylint: disable=broad-except
+                # Keep the other accounts, the sign out and the report
+                logging.exception('%s %s failed.', _ISP, _record['name'])
+                _record['status'] = f'Failed: {err!r}'
+            _record['avcid'] = _client.avcid
+            if _client.logged_in:
+                try:
+                    _client.logout(sign_out=not args.no_logout)
+                except LauntelError as err:
+                    logging.error('%s sign out failed: %s', _record['name'],
+                                  err)
+    finally:
+        if _lock is not None:
+            _lock.leave()
+    _record['requests'] = _client.requests
+    _record['seconds'] = round(time.monotonic() - _started, 3)
+    if _record['complete']:
+        logging.info('%s %s: %s', _ISP, _record['name'], _record['status'])
+    else:
+        logging.error('%s %s: %s', _ISP, _record['name'], _record['status'])
+    return _record
+
+
+def load_targets(path):
+    """
+    Load and validate a services targets file, a JSON object of avcid to
+    target like {"AVC000123456789": {"psid": "123", "up": 95, "down": 108}}
+    """
+    try:
+        with open(path, encoding='utf-8') as _file:
+            _targets = json.load(_file)
+    except (OSError, ValueError) as err:
+        raise LauntelError(f'Targets {path} not loaded: {err}') from err
+    if not isinstance(_targets, dict):
+        raise LauntelError(f'Targets {path} must map avcid to a target.')
+    for _avcid, _target in _targets.items():
+        _error = check_target(_target)
+        if _error is not None:
+            raise LauntelError(f'Target {_avcid} {_error}.')
+    return _targets
+
+
+def run_service(client, target, args):
+    """
+    Load a service's plan and shaper, and apply its target if any, return
+    its report record
+    """
+    _record = {'avcid': client.avcid, 'psid': '', 'plan': '', 'spend': None,
+               'shaper_down': '', 'shaper_up': '', 'complete': True,
+               'status': ''}
+    _latest = target.get('latest', False) if target else False
+    try:
+        _service = client.get_service(_latest)
+        _plan = client.get_speeds(_latest).get(_service.psid)
+        _shaper = client.get_shaper()
+        _record.update(psid=_service.psid,
+                       plan=_plan.name if _plan else '',
+                       spend=_plan.spend if _plan else None,
+                       shaper_down=_shaper.shaperdown_speed,
+                       shaper_up=_shaper.shaperup_speed)
+        if target:
+            _results = run_schedule_entry(
+                client, target, _shaper if 'psid' not in target else None,
+                args.reconcile, args.commit)
+            _record['complete'] = all(_result.complete
+                                      for _result in _results)
+            _record['status'] = '; '.join(_result.status
+                                          for _result in _results)
+    except (LauntelError, OSError) as err:
+        _record.update(complete=False, status=str(err))
+    except Exception as err:  # pylint: disable=broad-except
+        # Keep the other services and the sign out of the shared session
+        logging.exception('%s %s failed.', _ISP, _record['avcid'])
+        _record.update(complete=False, status=f'Failed: {err!r}')
+    return _record
+
+
+def run_services(client, args):
+    """
+    Load every service of the account, and apply the per avcid targets,
+    concurrently on the shared session, return True if all completed
+    """
+    from concurrent.futures import ThreadPoolExecutor  # pylint: disable=import-outside-toplevel
+    _targets = load_targets(os.path.expanduser(args.targets)) \
+        if args.targets is not None else {}
+    _services = client.get_services()
+    for _avcid in set(_targets) - {_service['avcid'] for _service in _services}:
+        logging.error('%s service %s not found on the account.', _ISP, _avcid)
+    _started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.workers) as _pool:
+        _records = list(_pool.map(
+            lambda _service: run_service(client.service_client(**_service),
+                                         _targets.get(_service['avcid']),
+                                         args),
+            _services))
+    logging.info('%s %s services loaded in %.2fs.', _ISP, len(_records),
+                 time.monotonic() - _started)
+    for _record in _records:
+        if not _record['complete']:
+            logging.error('%s %s: %s', _ISP, _record['avcid'],
+                          _record['status'])
+        elif _record['status'] != '':
+            logging.info('%s %s: %s', _ISP, _record['avcid'],
+                         _record['status'])
+    if args.output != 'table':
+        write_records([dict({'type': 'service'}, **_record)
+                       for _record in _records], args.output)
+    elif args.quiet is False:
+        print_records_table(f'{_ISP} Services', _records)
+    return all(_record['complete'] for _record in _records) and \
+        set(_targets) <= {_record['avcid'] for _record in _records}
+
+
+def run_fleet(args):
+    """
+    Apply the fleet file's accounts concurrently, at most args.workers at a
+    time, each with its own browser, and report the results
+    """
+    from concurrent.futures import ThreadPoolExecutor  # pylint: disable=import-outside-toplevel
+    _fleet = load_fleet(os.path.expanduser(args.config))
+    _started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.workers) as _pool:
+        _records = list(_pool.map(lambda _account: run_fleet_account(_account, args),
+                                  _fleet))
+    logging.info('%s fleet of %s accounts done in %.2fs, %s complete.', _ISP,
+                 len(_records), time.monotonic() - _started,
+                 sum(_record['complete'] for _record in _records))
+    if args.report is not None:
+        with open(os.path.expanduser(args.report), 'w',
+                  encoding='utf-8') as _file:
+            json.dump({'started': time.time() - (time.monotonic() - _started),
+                       'seconds': round(time.monotonic() - _started, 3),
+                       'accounts': _records}, _file, indent=2)
+    if args.output != 'table':
+        write_records([dict({'type': 'account'}, **_record)
+                       for _record in _records], args.output)
+    elif args.quiet is False:
+        print_records_table(f'{_ISP} Fleet', _records)
+    return all(_record['complete'] for _record in _records)
+
+
+def run_daemon(client, args):
+    """
+    Run the schedule forever on one warm client, the session is checked and
+    pages preloaded args.warmup seconds before each change
+    """
+    _schedule = load_schedule(os.path.expanduser(args.schedule))
+    logging.info('%s daemon loaded %s schedule entries.', _ISP,
+                 len(_schedule))
+    if args.commit is False:
+        logging.warning('Dry run, changes are only validated, use -c to '
+                        'commit them.')
+    while True:
+        _entry, _due = next_schedule_entry(_schedule, datetime.datetime.now())
+        logging.info('Next change at %s: %s', _due, _entry)
+        sleep_until(_due - datetime.timedelta(seconds=args.warmup))
+        _shaper = None
+        try:
+            # Re-authenticate only if the session expired, then preload the
+            # pages so only the change requests are left at the due time
+            with client.locked():
+                client.ensure_session(check=True)
+                client.get_service(_entry.get('latest', False))
+                client.get_speeds(_entry.get('latest', False))
+                if 'up' in _entry and 'down' in _entry and \
+                        'psid' not in _entry:
+                    _shaper = client.get_shaper()
+        except (LauntelError, OSError) as err:
+            logging.error('Warmup failed: %s', err)
+        sleep_until(_due)
+        _started = time.monotonic()
+        # The lock is only held for the change, so other mlss.py runs for
+        # the account can use the session in between
+        with client.locked():
+            try:
+                for _result in run_schedule_entry(client, _entry, _shaper,
+                                                  args.reconcile,
+                                                  args.commit):
+                    if _result.complete:
+                        logging.info('%s status is "%s".', _ISP,
+                                     _result.status)
+                    else:
+                        logging.error('%s status is "%s", please check '
+                                      'portal.', _ISP, _result.status)
+            except (LauntelError, OSError) as err:
+                logging.error('Change at %s failed: %s', _due, err)
+            logging.info('Change at %s applied in %.2fs.', _due,
+                         time.monotonic() - _started)
+            if client.session_cache != '':
+                client.save_session()
+
+
+def merge_changes(changes):
+    """
+    Return the final desired state of change requests in arrival order, the
+    last psid (with its latest) and the last up and down pair win
+    """
+    _entry = {}
+    for _change in changes:
+        if 'psid' in _change:
+            _entry['psid'] = str(_change['psid'])
+            _entry['latest'] = _change.get('latest', False)
+        if 'up' in _change and 'down' in _change:
+            _entry['up'] = _change['up']
+            _entry['down'] = _change['down']
+    return _entry
+
+
+class ChangeSpool:
+    """
+    Spool directory of change requests, one JSON file each like
+    {"psid": "123", "latest": false, "up": 95, "down": 108}. Requests are
+    debounced: they are merged until none arrive for window seconds, or
+    max_wait seconds after the first, so a burst is applied once.
+    """
+
+    def __init__(self, path, window=10.0, max_wait=60.0):
+        self.path = path
+        self.window = window
+        self.max_wait = max_wait
+        self.changes = []
+        self.files = []
+        self.first = None
+        self.last = None
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def check(change):
+        """
+        Raise ValueError if a change request has no psid or up and down, or
+        values of the wrong type
+        """
+        _error = check_target(change)
+        if _error is not None:
+            raise ValueError(_error)
+
+    def submit(self, change):
+        """
+        Write a change request atomically, return its path
+        """
+        self.check(change)
+        _name = f'{time.time_ns()}-{os.getpid()}'
+        _tmp = os.path.join(self.path, f'.{_name}.tmp')
+        with open(_tmp, 'w', encoding='utf-8') as _file:
+            json.dump(change, _file)
+        _path = os.path.join(self.path, f'{_name}.json')
+        os.replace(_tmp, _path)
+        return _path
+
+    def scan(self, now=None):
+        """
+        Read the new request files in arrival order, a request that isn't
+        valid is renamed to .rejected. Return the number read.
+        """
+        _now = time.monotonic() if now is None else now
+        _new = []
+        with os.scandir(self.path) as _entries:
+            for _dirent in _entries:
+                if _dirent.name.endswith('.json') and \
+                        _dirent.path not in self.files and _dirent.is_file():
+                    _new.append((_dirent.stat().st_mtime_ns, _dirent.name,
+                                 _dirent.path))
+        for _, _, _path in sorted(_new):
+            try:
+                with open(_path, encoding='utf-8') as _file:
+                    _change = json.load(_file)
+                self.check(_change)
+            except (OSError, ValueError) as err:
+                logging.error('Change request %s rejected: %s', _path, err)
+                try:
+                    os.replace(_path, f'{_path}.rejected')
+                except OSError:
+                    pass
+                continue
+            logging.debug('Change request %s: %s', _path, _change)
+            self.changes.append(_change)
+            self.files.append(_path)
+            self.first = _now if self.first is None else self.first
+            self.last = _now
+        return len(_new)
+
+    def due(self, now=None):
+        """
+        Return True once the pending requests are quiet for the window or
+        waited max_wait
+        """
+        _now = time.monotonic() if now is None else now
+        return bool(self.changes) and (
+            _now - self.last >= self.window or
+            _now - self.first >= self.max_wait)
+
+    def take(self):
+        """
+        Return the merged pending change and its request files, and start a
+        new batch
+        """
+        _entry, _files = merge_changes(self.changes), self.files
+        self.changes, self.files = [], []
+        self.first = self.last = None
+        return _entry, _files
+
+    @staticmethod
+    def done(files):
+        """
+        Remove applied request files
+        """
+        for _path in files:
+            try:
+                os.remove(_path)
+            except OSError as err:
+                logging.debug('Change request %s not removed: %s', _path, err)
+
+    @staticmethod
+    def keep(files, suffix):
+        """
+        Rename the request files of a change that failed or wasn't committed
+        to suffix, so they are kept but not applied again
+        """
+        for _path in files:
+            try:
+                os.replace(_path, f'{_path}{suffix}')
+            except OSError as err:
+                logging.debug('Change request %s not renamed: %s', _path, err)
+
+
+def run_spool(client, args):
+    """
+    Submit a change request, or apply the debounced requests of the spool
+    directory forever on one warm client, reconciling each merged change
+    so only the final desired state is written
+    """
+    _spool = ChangeSpool(os.path.expanduser(args.dir), args.window,
+                         args.max_wait)
+    if args.submit is not None:
+        try:
+            _path = _spool.submit(json.loads(args.submit))
+        except ValueError as err:
+            raise LauntelError(f'Change request not valid: {err}') from err
+        logging.info('Change request %s submitted.', _path)
+        return
+    logging.info('%s spool watching %s, applying changes after %ss quiet.',
+                 _ISP, _spool.path, args.window)
+    if args.commit is False:
+        logging.warning('Dry run, changes are only validated, use -c to '
+                        'commit them.')
+    while True:
+        _spool.scan()
+        if not _spool.due():
+            time.sleep(_SPOOL_POLL)
+            continue
+        _requests = len(_spool.files)
+        _entry, _files = _spool.take()
+        _started = time.monotonic()
+        logging.info('Applying %s from %s change requests.', _entry,
+                     _requests)
+        _complete = False
+        _changed = False
+        with client.locked():
+            try:
+                client.ensure_session(check=True)
+                _complete = True
+                for _result in run_schedule_entry(client, _entry,
+                                                  reconcile=True,
+                                                  commit=args.commit):
+                    _changed = _changed or _result.changed
+                    if _result.complete:
+                        logging.info('%s status is "%s".', _ISP,
+                                     _result.status)
+                    else:
+                        _complete = False
+                        logging.error('%s status is "%s", please check '
+                                      'portal.', _ISP, _result.status)
+            except (LauntelError, OSError) as err:
+                _complete = False
+                logging.error('Change %s failed: %s', _entry, err)
+            logging.info('Change applied in %.2fs.',
+                         time.monotonic() - _started)
+            if client.session_cache != '':
+                client.save_session()
+        if not _complete:
+            _spool.keep(_files, '.failed')
+        elif _changed and args.commit is False:
+            # Validated only, the requests are kept for a run with -c
+            _spool.keep(_files, '.dryrun')
+        else:
+            _spool.done(_files)
+
+
+def metric_labels(**labels):
+    """
+    Format Prometheus labels, escaping the values
+    """
+    return ','.join(
+        f'{_name}="' + str(_value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n') + '"'
+        for _name, _value in labels.items())
+
+
+class MetricsExporter:
+    """
+    Prometheus metrics of the service, plan and shaper, rendered once per
+    refresh so scrapes never reach the portal
+    """
+
+    def __init__(self, client, latest=False):
+        self.client = client
+        self.latest = latest
+        self.refreshes = 0
+        self.errors = 0
+        self.duration = 0.0
+        self.last_success = 0.0
+        self._state = []
+        self.metrics = self.render()
+
+    def refresh(self):
+        """
+        Reload the service, plan and shaper from the portal and render the
+        metrics, keeping the last state on errors
+        """
+        _started = time.monotonic()
+        try:
+            self.client.ensure_session(check=True)
+            _speeds = self.client.refresh_catalog(self.latest)
+            _service = self.client.get_service(self.latest)
+            _shaper = self.client.get_shaper()
+            self._state = self.state_metrics(_service,
+                                             _speeds.get(_service.psid),
+                                             _shaper)
+            self.last_success = time.time()
+        except (LauntelError, OSError) as err:
+            self.errors += 1
+            logging.error('Exporter refresh failed: %s', err)
+        self.refreshes += 1
+        self.duration = time.monotonic() - _started
+        self.metrics = self.render()
+
+    @staticmethod
+    def state_metrics(service, plan, shaper):
+        """
+        Return (name, type, help, [(labels, value)]) for the service state
+        """
+        _avcid = service.avcid
+        _metrics = [
+            ('launtel_service_psid', 'gauge', 'Active plan PSID',
+             [(metric_labels(avcid=_avcid), service.psid)]),
+        ]
+        if plan is not None:
+            _metrics += [
+                ('launtel_plan_info', 'gauge', 'Active plan',
+                 [(metric_labels(avcid=_avcid, psid=plan.psid,
+                                 name=plan.name), 1)]),
+                ('launtel_plan_daily_spend_dollars', 'gauge',
+                 'Active plan daily spend',
+                 [(metric_labels(avcid=_avcid), plan.spend)]),
+                ('launtel_plan_speed_mbps', 'gauge', 'Active plan speed',
+                 [(metric_labels(avcid=_avcid, direction='down'), plan.down),
+                  (metric_labels(avcid=_avcid, direction='up'), plan.up)]),
+            ]
+        _metrics += [
+            ('launtel_shaper_info', 'gauge',
+             'Shaper queue type and control modes',
+             [(metric_labels(avcid=_avcid, queue_type=shaper.queue_type,
+                             down_control=shaper.shaperdown_control,
+                             up_control=shaper.shaperup_control), 1)]),
+        ]
+        for _name, _help, _down, _up in (
+                ('speed', 'Shaper speed', shaper.shaperdown_speed,
+                 shaper.shaperup_speed),
+                ('min', 'Shaper minimum speed', shaper.shaperdown_min,
+                 shaper.shaperup_min),
+                ('max', 'Shaper maximum speed', shaper.shaperdown_max,
+                 shaper.shaperup_max)):
+            _metrics.append(
+                (f'launtel_shaper_{_name}_mbps', 'gauge', _help,
+                 [(metric_labels(avcid=_avcid, direction='down'), _down),
+                  (metric_labels(avcid=_avcid, direction='up'), _up)]))
+        return _metrics
+
+    def render(self) -> str:
+        """
+        Render the state and exporter metrics in the Prometheus text format
+        """
+        _metrics = self._state + [
+            ('launtel_exporter_refresh_seconds', 'gauge',
+             'Duration of the last portal refresh', [('', self.duration)]),
+            ('launtel_exporter_refreshes_total', 'counter',
+             'Portal refreshes', [('', self.refreshes)]),
+            ('launtel_exporter_refresh_errors_total', 'counter',
+             'Failed portal refreshes', [('', self.errors)]),
+            ('launtel_exporter_last_success_timestamp_seconds', 'gauge',
+             'Time of the last successful portal refresh',
+             [('', self.last_success)]),
+            ('launtel_exporter_portal_requests_total', 'counter',
+             'HTTP requests made to the portal',
+             [('', self.client.requests)]),
+        ]
+        _lines = []
+        for _name, _type, _help, _samples in _metrics:
+            _lines.append(f'# HELP {_name} {_help}')
+            _lines.append(f'# TYPE {_name} {_type}')
+            for _labels, _value in _samples:
+                _labels = f'{{{_labels}}}' if _labels else ''
+                _value = 'NaN' if _value in ('', None) else _value
+                _lines.append(f'{_name}{_labels} {_value}')
+        return '\n'.join(_lines) + '\n'
+
+
+def serve_metrics(exporter, address, port):
+    """
+    Serve the exporter's rendered metrics on /metrics from a background
+    thread, return the server
+    """
+    from http.server import BaseHTTPRequestHandler  # pylint: disable=import-outside-toplevel
+    from http.server import ThreadingHTTPServer  # pylint: disable=import-outside-toplevel
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        """
+        Answer /metrics with the last rendered metrics
+        """
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            """
+            Serve /metrics
+            """
+            if urlparse(self.path).path != '/metrics':
+                self.send_error(404)
+                return
+            _body = exporter.metrics.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(_body)))
+            self.end_headers()
+            self.wfile.write(_body)
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            logging.debug('Exporter %s', format % args)
+
+    _server = ThreadingHTTPServer((address, port), MetricsHandler)
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+    return _server
+
+
+def run_exporter(client, args):
+    """
+    Serve /metrics and refresh the portal data every args.interval seconds
+    on one warm client
+    """
+    _exporter = MetricsExporter(client, args.latest)
+    _server = serve_metrics(_exporter, args.address, args.port)
+    logging.info('%s exporter serving http://%s:%s/metrics, refreshing '
+                 'every %ss.', _ISP, args.address, _server.server_port,
+                 args.interval)
+    while True:
+        with client.locked():
+            _exporter.refresh()
+            if client.session_cache != '':
+                client.save_session()
+        time.sleep(args.interval)
+
+
+class ControlServer:
+    """
+    Local JSON API on one warm client for home automation. Reads are
+    answered from a TTL cache of the parsed service, speeds and shaper,
+    concurrent misses share one portal load. Writes are applied one at a
+    time from a queue, and all portal I/O runs on a single worker thread so
+    clients never trigger parallel logins.
+    """
+
+    def __init__(self, client, ttl=60.0, latest=False, commit=False):
+        self.client = client
+        self.ttl = ttl
+        self.latest = latest
+        self.commit = commit
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self._cache = {}
+        self._loading = {}
+        self._queue = None
+        import concurrent.futures  # pylint: disable=import-outside-toplevel
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='portal')
+
+    async def portal(self, func, *args):
+        """
+        Run func on the portal worker thread, holding the account lock and
+        verifying the session first
+        """
+        import asyncio  # pylint: disable=import-outside-toplevel
+
+        def _run():
+            with self.client.locked():
+                self.client.ensure_session(check=True)
+                _result = func(*args)
+                if self.client.session_cache != '':
+                    self.client.save_session()
+                return _result
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, _run)
+
+    def load_service(self, latest):
+        """
+        Return the service and speeds of the modify service page
+        """
+        _service = self.client.get_service(latest)
+        return {'service': asdict(_service),
+                'speeds': [dict(asdict(_plan),
+                                current=_plan.psid == _service.psid)
+                           for _plan in self.client.get_speeds(
+                               latest).values()]}
+
+    def load_shaper(self):
+        """
+        Return the shaper settings of the advanced info page
+        """
+        return asdict(self.client.get_shaper())
+
+    async def read(self, key, loader, *args):
+        """
+        Return the cached value of key, loading it with loader once for all
+        concurrent readers when it is missing or older than the ttl
+        """
+        import asyncio  # pylint: disable=import-outside-toplevel
+        _cached = self._cache.get(key)
+        if _cached is not None and _cached[0] > time.monotonic():
+            self.hits += 1
+            return _cached[1]
+        _task = self._loading.get(key)
+        if _task is None:
+            self.misses += 1
+
+            async def _load():
+                try:
+                    _value = await self.portal(loader, *args)
+                    self._cache[key] = (time.monotonic() + self.ttl, _value)
+                    return _value
+                finally:
+                    del self._loading[key]
+            _task = self._loading[key] = asyncio.ensure_future(_load())
+        return await asyncio.shield(_task)
+
+    async def write(self, func, *args):
+        """
+        Queue a change and return its ChangeResult once applied
+        """
+        import asyncio  # pylint: disable=import-outside-toplevel
+        _future = asyncio.get_running_loop().create_future()
+        await self._queue.put((func, args, _future))
+        return await _future
+
+    async def writer(self):
+        """
+        Apply the queued changes in order, dropping the cache after each
+        """
+        while True:
+            _func, _args, _future = await self._queue.get()
+            try:
+                _result = await self.portal(_func, *_args)
+                if not _future.cancelled():
+                    _future.set_result(_result)
+            except Exception as err:  # pylint: disable=broad-except
+                if not _future.cancelled():
+                    _future.set_exception(err)
+            finally:
+                self.writes += 1
+                self._cache = {}
+                self._queue.task_done()
+
+    async def route(self, method, path, query, body):
+        """
+        Return the status and JSON value of an API request
+        """
+        _latest = query.get('latest', [None])[0]
+        _latest = self.latest if _latest is None else _latest in ('1', 'true')
+        if (method, path) == ('GET', '/service'):
+            return 200, (await self.read(
+                ('service', _latest), self.load_service, _latest))['service']
+        if (method, path) == ('GET', '/speeds'):
+            return 200, (await self.read(
+                ('service', _latest), self.load_service, _latest))['speeds']
+        if (method, path) == ('GET', '/shaper'):
+            return 200, await self.read(('shaper',), self.load_shaper)
+        if (method, path) == ('POST', '/speed'):
+            _error = check_target(body) if 'psid' in body else \
+                'psid is required'
+            if _error is not None:
+                return 400, {'error': _error}
+            _latest = body.get('latest', _latest)
+            _result = await self.write(
+                functools.partial(self.client.change_speed, reconcile=True),
+                str(body['psid']), _latest, self.commit)
+            return 200, asdict(_result)
+        if (method, path) == ('POST', '/shaper'):
+            _up, _down = body.get('up'), body.get('down')
+            if any(isinstance(_speed, bool) or not isinstance(_speed, int)
+                   for _speed in (_up, _down)):
+                return 400, {'error': 'up and down Mbps are required'}
+            _result = await self.write(
+                functools.partial(self.client.set_shaper, reconcile=True),
+                _up, _down, self.commit)
+            return 200, asdict(_result)
+        if path in ('/service', '/speeds', '/shaper', '/speed'):
+            return 405, {'error': f'{method} not allowed'}
+        return 404, {'error': f'{path} not found'}
+
+    async def handle(self, reader, writer):
+        """
+        Answer the HTTP/1.1 requests of a connection
+        """
+        import asyncio  # pylint: disable=import-outside-toplevel
+        try:
+            while True:
+                _line = await reader.readline()
+                if not _line.strip():
+                    break
+                _method, _target, _ = _line.decode('latin-1').split(' ', 2)
+                _headers = {}
+                while True:
+                    _header = await reader.readline()
+                    if _header in (b'\r\n', b'\n', b''):
+                        break
+                    _name, _, _value = _header.decode('latin-1').partition(':')
+                    _headers[_name.strip().lower()] = _value.strip()
+                _length = int(_headers.get('content-length') or 0)
+                if _length > _SERVE_MAX_BODY:
+                    _status, _value = 413, {'error': 'body too large'}
+                else:
+                    _status, _value = await self.respond(
+                        _method, _target, await reader.readexactly(_length))
+                _body = json.dumps(_value).encode('utf-8')
+                _close = _headers.get('connection', '').lower() == 'close'
+                writer.write(
+                    f'HTTP/1.1 {_status} {_SERVE_REASONS[_status]}\r\n'
+                    'Content-Type: application/json\r\n'
+                    f'Content-Length: {len(_body)}\r\n'
+                    f'Connection: {"close" if _close else "keep-alive"}\r\n'
+                    '\r\n'.encode('latin-1') + _body)
+                await writer.drain()
+                logging.debug('Serve %s %s %s', _method, _target, _status)
+                if _close or _status == 413:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, method, target, body):
+        """
+        Parse the request body and route it, mapping errors to statuses
+        """
+        _url = urlparse(target)
+        try:
+            _body = json.loads(body) if body else {}
+            if not isinstance(_body, dict):
+                raise ValueError('not an object')
+        except ValueError as err:
+            return 400, {'error': f'JSON body not valid: {err}'}
+        try:
+            return await self.route(method, _url.path, parse_qs(_url.query),
+                                    _body)
+        except InvalidChange as err:
+            return 400, {'error': str(err)}
+        except (LauntelError, OSError) as err:
+            logging.error('Serve %s %s failed: %s', method, _url.path, err)
+            return 502, {'error': str(err)}
+        except Exception as err:  # pylint: disable=broad-except
+            logging.exception('Serve %s %s failed: %s', method, _url.path,
+                              err)
+            return 500, {'error': str(err)}
+
+    async def serve(self, address, port):
+        """
+        Serve the API until cancelled
+        """
+        import asyncio  # pylint: disable=import-outside-toplevel
+        self._queue = asyncio.Queue()
+        _writer = asyncio.ensure_future(self.writer())
+        _server = await asyncio.start_server(self.handle, address, port)
+        logging.info('%s API serving http://%s:%s, reads cached for %ss.',
+                     _ISP, address, _server.sockets[0].getsockname()[1],
+                     self.ttl)
+        try:
+            async with _server:
+                await _server.serve_forever()
+        finally:
+            _writer.cancel()
+            self._executor.shutdown(wait=True)
+
+
+def run_serve(client, args):
+    """
+    Serve the JSON API on one warm client until interrupted
+    """
+    import asyncio  # pylint: disable=import-outside-toplevel
+    if args.commit is False:
+        logging.warning('Dry run, changes are only validated, use -c to '
+                        'commit them.')
+    asyncio.run(ControlServer(client, args.ttl, args.latest,
+                              args.commit).serve(args.address, args.port))
+
+
+def run_speed(client, args, c_psid, speeds):
+    """
+    View or commit a speed change, return the complete status
+    """
+    if args.output != 'table':
+        write_records(speeds_records(client.get_service(args.latest), speeds,
+                                     args.latest), args.output)
+        # Records are for other tools, there is no one to prompt for a psid
+        if args.psid is None:
+            return True
+    # The table is still needed to choose a psid interactively
+    elif show_tables(args) or (args.psid is None and args.quiet is False):
+        print_speeds_table(speeds, c_psid, args.latest)
+    _psid = args.psid if args.psid is not None else ''
+    _psid_valid = False
+    # check and cater for non-interactive eg. cron based entry of PSID
+    if _psid != '':
+        _psid_valid = client.check_psid(_psid, args.latest, args.reconcile)
+        # if non-interactive PSID is false, logout
+        if _psid_valid is False:
+            return False
+
+    # check and cater for interactive entry of PSID, re-prompt if PSID is invalid
+    while _psid_valid is False:
+        _psid = input('Please enter psid: ')
+        _psid_valid = client.check_psid(_psid, args.latest, args.reconcile)
+
+    if args.reconcile is True and _psid == c_psid:
+        logging.info('%s psid is already %s, nothing to commit.', _ISP, _psid)
+        return True
+    _result = client.change_speed(_psid, args.latest, args.commit)
+    if args.commit is True:
+        if _result.complete:
+            logging.info('%s status is "Change in progress".', _ISP)
+        else:
             logging.error(
-                '%s status is not "Shaping settings updated - may take a minute to take effect", please check portal.',
+                '%s status is not "Change in progress", please check portal.',
                 _ISP)
-            logout()
+            return False
+        if args.wait is True:
+            return wait_for_change('speed', args, client.wait_for_speed,
+                                   _psid, args.latest)
+    # If we get to here Complete is considered True
+    return True
+
+
+def main():
+    """
+    Launtel Speed Info and Change CLI
+    """
+    global _CLIENT, _SIGN_OUT  # pylint: disable=global-statement
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    # parse the arguments
+    parser = create_parser()
+    args = parser.parse_args()
+    if args.compare is True and (args.psid is not None or args.commit is True
+                                 or args.command is not None):
+        parser.error('--compare only views the plans, it cannot be combined '
+                     'with -p, -c or a command')
+    _SIGN_OUT = not args.no_logout
+
+    if args.debug is True:
+        logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+        logging.debug('Debug is True.')
+    else:
+        logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    logging.debug('Commit is %s.', args.commit)
+    logging.debug('Use latest psid options is %s.', args.latest)
+    logging.debug('Shaper control is %s.', args.command == 'shaper')
+
+    _session_cache = ''
+    if args.session_cache is not None:
+        _session_cache = os.path.expanduser(args.session_cache)
+    _catalog = None
+    if args.catalog_cache is not None:
+        _catalog = PlanCatalog(os.path.expanduser(args.catalog_cache),
+                               args.catalog_ttl)
+        if args.refresh_catalog is True:
+            _catalog.invalidate()
+    # Runs sharing a session cache take turns on the portal and reuse the
+    # session, the last one out signs out
+    _lock = None
+    if _session_cache != '' and args.command not in ('history', 'fleet'):
+        _lock = AccountLock(_session_cache)
+        _lock.join()
+    _history = None
+    if args.history is not None:
+        _history = HistoryStore(os.path.expanduser(args.history))
+    _cassette = None
+    _credentials = load_credentials
+    if args.replay is not None:
+        try:
+            _cassette = Cassette.load(os.path.expanduser(args.replay))
+        except LauntelError as err:
+            logging.error(err)
+            return 1
+        _credentials = replay_credentials
+    elif args.record is not None:
+        _cassette = Cassette(os.path.expanduser(args.record))
+    _tracer = Tracer(args.trace)
+    _profiler = None
+    if args.profile is not None:
+        import cProfile  # pylint: disable=import-outside-toplevel
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    # The cached session is reused when it is still alive, credentials are
+    # only loaded when a login is needed
+    _CLIENT = client = LauntelClient(session_cache=_session_cache,
+                                     catalog=_catalog,
+                                     credentials=_credentials,
+                                     tracer=_tracer,
+                                     timeout=args.timeout,
+                                     retries=args.retries,
+                                     history=_history,
+                                     lock=_lock,
+                                     pooled=not args.no_keepalive,
+                                     cassette=_cassette)
+    try:
+        with _tracer.span('run', command=args.command or 'speed'):
+            if args.command in ('daemon', 'exporter', 'serve', 'spool'):
+                # Long running commands only hold the lock for each change
+                run_command(client, args, _catalog)
+            else:
+                with client.locked():
+                    run_command(client, args, _catalog)
+    finally:
+        if _lock is not None:
+            _lock.leave()
+        if _profiler is not None:
+            _profiler.disable()
+            _profiler.dump_stats(args.profile)
+        if _history is not None:
+            _history.close()
+        if _cassette is not None and _cassette.replaying is False:
+            _cassette.save()
+        _tracer.close()
+
+
+def history_range(args):
+    """
+    Return the since and until timestamps of a history query
+    """
+    try:
+        if args.until is not None:
+            _until = datetime.datetime.strptime(args.until, '%Y-%m-%d')
+        else:
+            _until = datetime.datetime.now()
+        if args.since is not None:
+            _since = datetime.datetime.strptime(args.since, '%Y-%m-%d')
+        else:
+            _since = _until - datetime.timedelta(days=args.days)
+    except ValueError as err:
+        raise LauntelError(f'History date not valid: {err}') from err
+    return _since.timestamp(), _until.timestamp()
+
+
+def print_records_table(title, records):
+    """
+    Print records as a table with a column per key
+    """
+    from rich import box  # pylint: disable=import-outside-toplevel
+    from rich.console import Console  # pylint: disable=import-outside-toplevel
+    from rich.table import Table  # pylint: disable=import-outside-toplevel
+    _table = Table(show_header=True, header_style='bold magenta', title=title,
+                   box=box.SQUARE)
+    for _column in records[0] if records else ():
+        _table.add_column(_column.upper())
+    for _record in records:
+        _table.add_row(*('' if _value is None else str(_value)
+                         for _value in _record.values()))
+    Console().print(_table)
+
+
+def run_history(history, args):
+    """
+    Print the changes, or the daily spend, in the queried range
+    """
+    if history is None:
+        raise LauntelError('history needs --history FILE.')
+    _since, _until = history_range(args)
+    if args.spend is True:
+        _records = history.daily_spend(_since, _until, args.avcid)
+        _title = f'{_ISP} Daily Spend'
+    else:
+        _records = history.changes(_since, _until, args.avcid)
+        for _record in _records:
+            _record['ts'] = datetime.datetime.fromtimestamp(
+                _record['ts']).isoformat(sep=' ', timespec='seconds')
+        _title = f'{_ISP} Changes'
+    if args.output != 'table':
+        write_records([dict({'type': 'spend' if args.spend else 'change'},
+                            **_record) for _record in _records], args.output)
     else:
-        # Commit is false
-        # Set Complte to True and Logout
-        _COMPLETE = True
-        logout()
-
-print_speeds_table()
-# check and cater for non-interactive eg. cron based entry of PSID
-if _PSID != '':
-    _PSID_VALID = check_psid()
-    # if non-interactive PSID is false, logout
-    if _PSID_VALID is False:
-        logout()
-
-# check and cater for interactive entry of PSID, re-prompt if PSID is invalid
-while _PSID_VALID is False:
-    _PSID = input('Please enter psid: ')
-    _PSID_VALID = check_psid()
-
-if _PSID_VALID is True:
-    submit_service_modification()
-else:
-    logging.error("Requested psid is not valid.")
-    logout()
-
-_COMPLETE = True  # If we get to here Complete is considered True
-logout()
+        print_records_table(_title, _records)
+    if args.spend is True:
+        logging.info('%s total spend over %s days is $%.2f.', _ISP,
+                     len({_record['day'] for _record in _records}),
+                     sum(_record['spend'] for _record in _records))
+
+
+def catalog_view(client, args):
+    """
+    Return the cached Speeds if the run only views the plans, None if the
+    portal is needed. Commits and -r always diff against a fresh read.
+    """
+    if args.command is None and args.psid is None and \
+            args.commit is False and args.reconcile is False and \
+            args.output == 'table':
+        return client.cached_speeds(args.latest)
+    return None
+
+
+def run_command(client, args, catalog):
+    """
+    Run the speed, shaper, daemon, exporter, serve, spool or history
+    command with the client
+    """
+    if args.command == 'history':
+        try:
+            run_history(client.history, args)
+        except LauntelError as err:
+            logging.error(err)
+        return
+    if args.command == 'fleet':
+        try:
+            run_fleet(args)
+        except LauntelError as err:
+            logging.error(err)
+        return
+    if args.command == 'daemon':
+        try:
+            run_daemon(client, args)
+        except LauntelError as err:
+            logging.error(err)
+        return
+    if args.command == 'exporter':
+        run_exporter(client, args)
+        return
+    if args.command == 'serve':
+        run_serve(client, args)
+        return
+    if args.command == 'spool':
+        try:
+            run_spool(client, args)
+        except LauntelError as err:
+            logging.error(err)
+        return
+    if args.command == 'services':
+        _results = {'services': False}
+        try:
+            _results['services'] = run_services(client, args)
+        except LauntelError as err:
+            logging.error(err)
+        finish(client, args, _results)
+        return
+    if args.compare is True:
+        _results = {'compare': False}
+        try:
+            _results['compare'] = run_compare(client, args)
+        except LauntelError as err:
+            logging.error(err)
+        finish(client, args, _results)
+        return
+
+    # Changing both the speed and the shaper uses one session
+    if args.command == 'shaper' and args.psid is not None:
+        _results = {'speed': False, 'shaper': False}
+    elif args.command == 'shaper':
+        _results = {'shaper': False}
+    else:
+        _results = {'speed': False}
+    try:
+        if args.debug is True and catalog is None:
+            client.ensure_session()
+            logging.debug('session_id=%s', client.session_id())
+            logging.debug('%s service status is %sActive.', _ISP,
+                          '' if client.service_active() else 'not ')
+        _speeds = catalog_view(client, args)
+        if _speeds is not None:
+            # The active PSID isn't cached, only the plans are listed
+            logging.info('%s plans from the catalog cache, the active PSID '
+                         'is not shown.', _ISP)
+            _c_psid = None
+        else:
+            _c_psid = client.get_service(args.latest).psid
+            _speeds = client.get_speeds(args.latest)
+        _target = None
+        if 'speed' in _results and 'shaper' in _results and \
+                args.psid in _speeds:
+            # Validate the shaper for the new plan before the speed changes
+            _target = target_shaper(client, args, _c_psid, _speeds,
+                                    args.psid)
+        if 'speed' in _results:
+            _results['speed'] = run_speed(client, args, _c_psid, _speeds)
+        if 'shaper' in _results and _results.get('speed', True) is True:
+            _results['shaper'] = run_shaper(client, args, _c_psid, _speeds,
+                                            args.psid, _target)
+    except LauntelError as err:
+        logging.error(err)
+    finish(client, args, _results)
+
+
+if __name__ == '__main__':
+    sys.exit(main())